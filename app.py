@@ -1,263 +1,289 @@
 import streamlit as st
 import pandas as pd
 import io
-import csv
-import re
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill, Font, Border, Side, Alignment
-from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl.utils import get_column_letter
-
-# Table de correspondance Diametre -> Lettre pour FP2E
-diametre_lettre = {
-    15: ['A', 'U', 'V'],
-    20: ['B'],
-    25: ['C'],
-    30: ['D'],
-    40: ['E'],
-    50: ['F'],
-    60: ['G'],
-    65: ['G'],
-    80: ['H'],
-    100: ['I'],
-    125: ['J'],
-    150: ['K']
+
+from controle import (
+    ANNULEE, BUDGET_MEMOIRE, ECHEC, LIGNES_MIN_PARALLELE, PROCESSUS, REGLES, VERSION_LECTURE, VERSION_REGLES,
+    CACHE_REPERTOIRE, CACHE_TAILLE_MAX,
+    CacheResultats, ColonnesManquantes, GestionnaireTaches, Historique, Mesures, check_data, check_data_incremental,
+    check_data_par_blocs, check_data_parallele, colonnes_affichees, colonnes_chargees, colonnes_fichier,
+    colonnes_lues, detecter_colonnes_modifiees, detecter_format_csv, dtype_mapping, dtypes_lecture,
+    ecrire_rapport_csv, ecrire_rapport_excel, ecrire_rapport_parquet, ecrire_rapport_zip, empreinte_fichier,
+    extension_fichier, extensions, fichier_export, formats_colonnes, lignes_par_bloc, lire_fichier,
+    regles_dependantes
+)
+
+def afficher_resume_anomalies(anomaly_counter):
+    """
+    Affiche un résumé des anomalies.
+    """
+    if not anomaly_counter.empty:
+        summary_df = pd.DataFrame(anomaly_counter).reset_index()
+        summary_df.columns = ["Type d'anomalie", "Nombre de cas"]
+        st.subheader("Récapitulatif des anomalies")
+        st.dataframe(summary_df)
+
+@st.cache_resource
+def cache_resultats():
+    """
+    Cache de résultats partagé par toutes les sessions de l'application.
+    """
+    return CacheResultats(CACHE_TAILLE_MAX, CACHE_REPERTOIRE)
+
+def controle_precedent(cache, df, colonnes_conservees):
+    """
+    Si le fichier téléversé est une version corrigée du dernier fichier
+    contrôlé (mêmes lignes, mêmes colonnes conservées), renvoie les anomalies
+    du contrôle précédent et les colonnes modifiées, pour ne réévaluer que
+    les règles concernées. Renvoie (None, None) sinon.
+    """
+    empreinte_precedente = st.session_state.get('dernier_controle')
+    if empreinte_precedente is None:
+        return None, None
+    lecture_precedente = cache.get((empreinte_precedente, VERSION_LECTURE, 'lecture', False, colonnes_conservees))
+    resultats_precedents = cache.get((empreinte_precedente, VERSION_REGLES, VERSION_LECTURE, False, colonnes_conservees, None,
+                                      'controles'))
+    if lecture_precedente is None or resultats_precedents is None:
+        return None, None
+    colonnes_modifiees = detecter_colonnes_modifiees(lecture_precedente[0], df)
+    if colonnes_modifiees is None:
+        return None, None
+    regles = regles_dependantes(colonnes_modifiees)
+    st.info(f"Fichier identique au précédent hormis les colonnes {', '.join(colonnes_modifiees) or '(aucune)'} : "
+            f"{len(regles)} règle(s) réévaluée(s).")
+    return resultats_precedents[0], colonnes_modifiees
+
+@st.cache_resource
+def gestionnaire_taches():
+    """
+    Gestionnaire des tâches de fond partagé par toutes les sessions.
+    """
+    return GestionnaireTaches()
+
+# Rapports : étape de la tâche, libellé du bouton, nom du fichier et type MIME
+RAPPORTS = {
+    'csv': ("Rapport CSV", "Télécharger les anomalies en CSV", 'anomalies_radioreleve.csv', 'text/csv'),
+    'xlsx': ("Rapport Excel", "Télécharger les anomalies en Excel", 'anomalies_radioreleve.xlsx',
+             'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'parquet': ("Rapport Parquet", "Télécharger les anomalies en Parquet", 'anomalies_radioreleve.parquet',
+                'application/vnd.apache.parquet'),
+    'zip': ("Archive ZIP", "Télécharger l'archive ZIP (anomalies, une liste par type, récapitulatif)",
+            'anomalies_radioreleve.zip', 'application/zip'),
 }
 
-def get_csv_delimiter(file):
+def formats_rapport(file_extension, archive=False):
     """
-    Détecte automatiquement le délimiteur d'un fichier CSV.
+    Rapports proposés pour un fichier : CSV, puis Excel ou Parquet selon le
+    format du fichier, et l'archive ZIP si elle est demandée.
     """
-    try:
-        sample = file.read(2048).decode('utf-8')
-        dialect = csv.Sniffer().sniff(sample)
-        file.seek(0)
-        return dialect.delimiter
-    except Exception:
-        file.seek(0)
-        return ','
-
-# --- Fonction de vérification FP2E modifiée pour plus de précision ---
-def check_fp2e_details(row):
+    formats = ['csv']
+    if file_extension == 'xlsx':
+        formats.append('xlsx')
+    elif file_extension in formats_colonnes:
+        formats.append('parquet')
+    if archive:
+        formats.append('zip')
+    return formats
+
+def ecrire_rapport(format_rapport, resultats, delimiter, mesures):
     """
-    Vérifie les détails de la norme FP2E et renvoie une chaîne détaillée
-    du problème.
+    Contenu du rapport d'anomalies au format donné. Le rapport est écrit au
+    fil de l'eau dans un fichier temporaire (voir fichier_export), qui n'est
+    lu qu'une fois terminé : st.download_button attend le contenu complet,
+    qui est donc chargé en entier en mémoire.
     """
-    anomalies = []
-    
-    try:
-        compteur = str(row['Numéro de compteur']).strip()
-        annee_fabrication_val = str(row['Année de fabrication']).strip()
-        diametre_val = row['Diametre']
-        
-        # Vérification 1 : Format du compteur
-        fp2e_regex = r'^[A-Z]\d{2}[A-Z]{2}\d{6}$'
-        if not re.match(fp2e_regex, compteur):
-            return 'Conforme'
-
-        annee_compteur = compteur[1:3]
-        lettre_diam = compteur[4].upper()
-        
-        # Vérification 2 : Année de fabrication
-        annee_non_conforme = False
-        if annee_fabrication_val == '' or not annee_fabrication_val.isdigit():
-            anomalies.append('L\'année de millésime n\'est pas conforme')
-            annee_non_conforme = True
+    anomalies_df, _, anomaly_index = resultats
+    with fichier_export() as sortie:
+        if format_rapport == 'xlsx':
+            ecrire_rapport_excel(anomalies_df, anomaly_index, sortie, mesures)
+        elif format_rapport == 'parquet':
+            ecrire_rapport_parquet(anomalies_df, sortie, mesures)
+        elif format_rapport == 'zip':
+            ecrire_rapport_zip(anomalies_df, anomaly_index, sortie, delimiter or ',', mesures)
         else:
-            annee_fabrication_padded = annee_fabrication_val.zfill(2)
-            if annee_compteur != annee_fabrication_padded:
-                anomalies.append('L\'année de millésime n\'est pas conforme')
-                annee_non_conforme = True
-        
-        # Vérification 3 : Diamètre
-        diametre_non_conforme = False
-        fp2e_map = {'A': 15, 'U': 15, 'V': 15, 'B': 20, 'C': 25, 'D': 30, 'E': 40, 'F': 50, 'G': [60, 65], 'H': 80, 'I': 100, 'J': 125, 'K': 150}
-        expected_diametres = fp2e_map.get(lettre_diam, [])
-        if not isinstance(expected_diametres, list):
-            expected_diametres = [expected_diametres]
-
-        if pd.isna(diametre_val) or diametre_val not in expected_diametres:
-            anomalies.append('Le diamètre n\'est pas conforme')
-            diametre_non_conforme = True
-        
-        # Si aucune des anomalies spécifiques n'a été déclenchée, mais que le format est bon, c'est que c'est une autre anomalie
-        if not anomalies and (not annee_non_conforme and not diametre_non_conforme):
-            # Le format est bon, mais pas l'année ou le diamètre, donc pas de nouvelle anomalie
-            pass
-        
-    except (TypeError, ValueError, IndexError):
-        anomalies.append('Le numéro de compteur n\'est pas conforme')
-    
-    if not anomalies:
-        return 'Conforme'
-    else:
-        return ' / '.join(anomalies)
+            ecrire_rapport_csv(anomalies_df, sortie, delimiter or ',', mesures)
+        sortie.seek(0)
+        return sortie.read()
 
-def check_data(df):
+def controler(tache, cache, cle_controles, df, fichier, nom_fichier, delimiter, usecols, referentiel, precedent,
+              colonnes_modifiees):
     """
-    Vérifie les données du DataFrame pour détecter les anomalies en utilisant des opérations vectorisées.
-    Retourne un DataFrame avec les lignes contenant des anomalies.
+    Contrôles d'une tâche de fond : par blocs si fichier est fourni,
+    incrémentaux si referentiel est fourni, sinon complets ou limités aux
+    règles concernées par les colonnes_modifiees depuis le contrôle precedent.
     """
-    df_with_anomalies = df.copy()
-
-    df_with_anomalies['Année de fabrication'] = df_with_anomalies['Année de fabrication'].astype(str).replace('nan', '', regex=False)
-    df_with_anomalies['Année de fabrication'] = df_with_anomalies['Année de fabrication'].apply(
-        lambda x: str(int(float(x))) if x.replace('.', '', 1).isdigit() and x != '' else x
-    )
-    df_with_anomalies['Année de fabrication'] = df_with_anomalies['Année de fabrication'].str.slice(-2).str.zfill(2)
-    
-    # Vérification des colonnes requises
-    required_columns = ['Protocole Radio', 'Marque', 'Numéro de tête', 'Numéro de compteur', 'Latitude', 'Longitude', 'Commune', 'Année de fabrication', 'Diametre', 'Mode de relève']
-    if not all(col in df_with_anomalies.columns for col in required_columns):
-        missing_columns = [col for col in required_columns if col not in df_with_anomalies.columns]
-        st.error(f"Colonnes requises manquantes : {', '.join(missing_columns)}")
-        st.stop()
+    if fichier is not None:
+        tache.commencer('Contrôles')
+        return check_data_par_blocs(
+            fichier, delimiter, dtype_mapping, encoding=detecter_format_csv(fichier)[0], usecols=usecols,
+            progression=lambda nb_lignes: tache.avancer(fichier.tell() / max(len(fichier.getbuffer()), 1)),
+            mesures=tache
+        )
+    # Normalisation, chaque règle, jointure, libellés et index de chaque bloc de lignes (et valeurs des règles
+    # transverses et catégories s'il y a plusieurs blocs), ou étapes du contrôle réparti sur plusieurs processus
+    parallele = precedent is None and PROCESSUS > 1 and len(df) >= LIGNES_MIN_PARALLELE
+    nb_blocs = -(-len(df) // lignes_par_bloc(len(df)))
+    tache.commencer('Contrôles', 5 if parallele else nb_blocs * (len(REGLES) + 4) + 2 * (nb_blocs > 1))
+    if referentiel:
+        *resultats, bilan = check_data_incremental(df, Historique.depuis_nom(referentiel), nom_fichier, tache)
+        tache.terminer('Contrôles', bilan=cache.put(cle_controles + ('bilan',), bilan))
+        return tuple(resultats)
+    if precedent is not None:
+        return check_data(df, precedent, colonnes_modifiees, mesures=tache)
+    # Les tâches simultanées se partagent un même groupe de processus, que le serveur multithread ne crée pas par fork
+    return check_data_parallele(df, mesures=tache, partage=True)
+
+def executer_controles(tache, cache, cle_controles, df, resultats, formats, fichier, nom_fichier, delimiter, usecols,
+                       referentiel, precedent, colonnes_modifiees):
+    """
+    Tâche de fond : contrôles (voir controler), sauf si leurs resultats sont
+    fournis, puis rapports aux formats donnés. Chaque résultat est mis en
+    cache et publié dès qu'il est prêt.
+    """
+    if resultats is None:
+        resultats = controler(tache, cache, cle_controles, df, fichier, nom_fichier, delimiter, usecols, referentiel,
+                              precedent, colonnes_modifiees)
+    tache.terminer('Contrôles', controles=cache.put(cle_controles + ('controles',), resultats))
+
+    if resultats[0].empty:
+        for format_rapport in formats:
+            tache.terminer(RAPPORTS[format_rapport][0])
+        return
+    for format_rapport in formats:
+        etape = RAPPORTS[format_rapport][0]
+        # Largeurs, feuille de toutes les anomalies, feuille de chaque type et enregistrement ;
+        # CSV de toutes les anomalies et de chaque type pour l'archive
+        sous_etapes = {'xlsx': len(resultats[2]) + 3, 'zip': len(resultats[2]) + 1}
+        tache.commencer(etape, sous_etapes.get(format_rapport, 1))
+        contenu = ecrire_rapport(format_rapport, resultats, delimiter, tache)
+        tache.terminer(etape, **{format_rapport: cache.put(cle_controles + (format_rapport,), contenu)})
+
+def message_erreur(tache):
+    """
+    Message affiché pour une tâche en échec, selon l'étape qui a échoué.
+    """
+    if isinstance(tache.erreur, ColonnesManquantes):
+        return str(tache.erreur)
+    if tache.etape_echec in (None, 'Contrôles'):
+        return f"Erreur lors des contrôles : {tache.erreur}"
+    return f"Erreur lors de l'étape {tache.etape_echec} : {tache.erreur}"
 
-    df_with_anomalies['Anomalie'] = ''
-    df_with_anomalies['Anomalie Détaillée FP2E'] = '' # Colonne pour les détails FP2E
-
-    # Conversion des colonnes pour les analyses et remplacement des NaN par des chaînes vides
-    df_with_anomalies['Numéro de compteur'] = df_with_anomalies['Numéro de compteur'].astype(str).replace('nan', '', regex=False)
-    df_with_anomalies['Numéro de tête'] = df_with_anomalies['Numéro de tête'].astype(str).replace('nan', '', regex=False)
-    df_with_anomalies['Marque'] = df_with_anomalies['Marque'].astype(str).replace('nan', '', regex=False)
-    df_with_anomalies['Protocole Radio'] = df_with_anomalies['Protocole Radio'].astype(str).replace('nan', '', regex=False)
-    df_with_anomalies['Mode de relève'] = df_with_anomalies['Mode de relève'].astype(str).replace('nan', '', regex=False)
-    
-    # Conversion des colonnes Latitude et Longitude en numérique pour éviter le TypeError
-    df_with_anomalies['Latitude'] = pd.to_numeric(df_with_anomalies['Latitude'], errors='coerce')
-    df_with_anomalies['Longitude'] = pd.to_numeric(df_with_anomalies['Longitude'], errors='coerce')
-
-    # Marqueurs pour les conditions
-    is_kamstrup = df_with_anomalies['Marque'].str.upper() == 'KAMSTRUP'
-    is_sappel = df_with_anomalies['Marque'].str.upper().isin(['SAPPEL (C)', 'SAPPEL (H)'])
-    is_itron = df_with_anomalies['Marque'].str.upper() == 'ITRON'
-    annee_fabrication_num = pd.to_numeric(df_with_anomalies['Année de fabrication'], errors='coerce')
-    df_with_anomalies['Diametre'] = pd.to_numeric(df_with_anomalies['Diametre'], errors='coerce')
-
-    # ------------------------------------------------------------------
-    # ANOMALIES GÉNÉRALES
-    # ------------------------------------------------------------------
-    
-    condition_protocole_manquant = (df_with_anomalies['Protocole Radio'].isin(['', 'nan'])) & (df_with_anomalies['Mode de relève'].str.upper() != 'MANUELLE')
-    df_with_anomalies.loc[condition_protocole_manquant, 'Anomalie'] += 'Protocole Radio manquant / '
-    df_with_anomalies.loc[df_with_anomalies['Marque'].isin(['', 'nan']), 'Anomalie'] += 'Marque manquante / '
-    df_with_anomalies.loc[df_with_anomalies['Numéro de compteur'].isin(['', 'nan']), 'Anomalie'] += 'Numéro de compteur manquant / '
-    df_with_anomalies.loc[df_with_anomalies['Diametre'].isnull(), 'Anomalie'] += 'Diamètre manquant / '
-    df_with_anomalies.loc[df_with_anomalies['Année de fabrication'].isnull(), 'Anomalie'] += 'Année de fabrication manquante / '
-    
-    condition_tete_manquante = (df_with_anomalies['Numéro de tête'].isin(['', 'nan'])) & \
-        (~is_sappel | (annee_fabrication_num >= 22)) & \
-        (df_with_anomalies['Mode de relève'].str.upper() != 'MANUELLE')
-    df_with_anomalies.loc[condition_tete_manquante, 'Anomalie'] += 'Numéro de tête manquant / '
-
-    df_with_anomalies.loc[df_with_anomalies['Latitude'].isnull() | df_with_anomalies['Longitude'].isnull(), 'Anomalie'] += 'Coordonnées GPS non numériques / '
-    coord_invalid = ((df_with_anomalies['Latitude'] == 0) | (~df_with_anomalies['Latitude'].between(-90, 90))) | \
-                    ((df_with_anomalies['Longitude'] == 0) | (~df_with_anomalies['Longitude'].between(-180, 180)))
-    df_with_anomalies.loc[coord_invalid, 'Anomalie'] += 'Coordonnées GPS invalides / '
-
-    # ------------------------------------------------------------------
-    # ANOMALIES SPÉCIFIQUES AUX MARQUES
-    # ------------------------------------------------------------------
-    
-    # KAMSTRUP
-    kamstrup_valid = is_kamstrup & (~df_with_anomalies['Numéro de tête'].isin(['', 'nan']))
-    df_with_anomalies.loc[is_kamstrup & (df_with_anomalies['Numéro de compteur'].str.len() != 8), 'Anomalie'] += 'KAMSTRUP: Compteur ≠ 8 caractères / '
-    df_with_anomalies.loc[kamstrup_valid & (df_with_anomalies['Numéro de compteur'] != df_with_anomalies['Numéro de tête']), 'Anomalie'] += 'KAMSTRUP: Compteur ≠ Tête / '
-    df_with_anomalies.loc[kamstrup_valid & (~df_with_anomalies['Numéro de compteur'].str.isdigit() | ~df_with_anomalies['Numéro de tête'].str.isdigit()), 'Anomalie'] += 'KAMSTRUP: Compteur ou Tête non numérique / '
-    df_with_anomalies.loc[is_kamstrup & (~df_with_anomalies['Diametre'].between(15, 80)), 'Anomalie'] += 'KAMSTRUP: Diamètre hors plage / '
-    df_with_anomalies.loc[is_kamstrup & (df_with_anomalies['Protocole Radio'].str.upper() != 'WMS'), 'Anomalie'] += 'KAMSTRUP: Protocole ≠ WMS / '
-
-    # SAPPEL
-    sappel_valid_tete_dme = is_sappel & (df_with_anomalies['Numéro de tête'].astype(str).str.upper().str.startswith('DME'))
-    df_with_anomalies.loc[sappel_valid_tete_dme & (df_with_anomalies['Numéro de tête'].str.len() != 15), 'Anomalie'] += 'SAPPEL: Tête DME ≠ 15 caractères / '
-    
-    # Nouvelle logique: on applique la règle SAPPEL seulement si le mode n'est pas "Manuelle"
-    sappel_non_manuelle = is_sappel & (df_with_anomalies['Mode de relève'].str.upper() != 'MANUELLE')
-    df_with_anomalies.loc[sappel_non_manuelle & (~df_with_anomalies['Numéro de compteur'].str.startswith(('C', 'H'))), 'Anomalie'] += 'SAPPEL: Compteur ne commence pas par C ou H / '
-    
-    df_with_anomalies.loc[(is_sappel) & (df_with_anomalies['Numéro de compteur'].str.startswith('C')) & (df_with_anomalies['Marque'].str.upper() != 'SAPPEL (C)'), 'Anomalie'] += 'SAPPEL: Incohérence Marque/Compteur (C) / '
-    
-    df_with_anomalies.loc[(is_sappel) & (df_with_anomalies['Numéro de compteur'].str.startswith('H')) & (df_with_anomalies['Marque'].str.upper() != 'SAPPEL (H)'), 'Anomalie'] += 'SAPPEL: Incohérence Marque/Compteur (H) / '
-    df_with_anomalies.loc[is_sappel & (annee_fabrication_num > 22) & (~df_with_anomalies['Numéro de tête'].astype(str).str.upper().str.startswith('DME')), 'Anomalie'] += 'SAPPEL: Année >22 & Tête ≠ DME / '
-    df_with_anomalies.loc[is_sappel & (annee_fabrication_num > 22) & (df_with_anomalies['Protocole Radio'].str.upper() != 'OMS'), 'Anomalie'] += 'SAPPEL: Année >22 & Protocole ≠ OMS / '
-
-    # ITRON
-    # Nouvelle logique: on applique la règle ITRON seulement si le mode n'est pas "Manuelle"
-    itron_non_manuelle = is_itron & (df_with_anomalies['Mode de relève'].str.upper() != 'MANUELLE')
-    df_with_anomalies.loc[itron_non_manuelle & (~df_with_anomalies['Numéro de compteur'].str.startswith(('I', 'D'))), 'Anomalie'] += 'ITRON: Compteur ne commence pas par I ou D / '
-
-
-    # ------------------------------------------------------------------
-    # LOGIQUE POUR LA NORME FP2E
-    # ------------------------------------------------------------------
-    
-    fp2e_regex = r'^[A-Z]\d{2}[A-Z]{2}\d{6}$'
-    
-    # Condition 1: La marque est SAPPEL ET le mode de relève n'est pas "MANUELLE"
-    sappel_non_manuelle = is_sappel & (df_with_anomalies['Mode de relève'].str.upper() != 'MANUELLE')
-    
-    # Condition 2: Le mode de relève est "MANUELLE" ET le numéro de compteur respecte le format FP2E
-    manuelle_format_ok = (df_with_anomalies['Mode de relève'].str.upper() == 'MANUELLE') & (df_with_anomalies['Numéro de compteur'].str.match(fp2e_regex, na=False))
-    
-    # Les contrôles FP2E ne s'appliquent que si l'une des deux conditions est vraie
-    fp2e_check_condition = sappel_non_manuelle | manuelle_format_ok
-    
-    # Appliquer la vérification détaillée et fusionner les résultats
-    fp2e_results = df_with_anomalies[fp2e_check_condition].apply(check_fp2e_details, axis=1)
-    
-    # Mettre à jour les colonnes d'anomalies avec les résultats détaillés FP2E
-    for index, anomaly_str in fp2e_results.items():
-        if anomaly_str != 'Conforme':
-            df_with_anomalies.loc[index, 'Anomalie'] += anomaly_str + ' / '
-            df_with_anomalies.loc[index, 'Anomalie Détaillée FP2E'] = anomaly_str
-    
-    # Nettoyage de la colonne 'Anomalie'
-    df_with_anomalies['Anomalie'] = df_with_anomalies['Anomalie'].str.strip().str.rstrip(' /')
-    
-    anomalies_df = df_with_anomalies[df_with_anomalies['Anomalie'] != ''].copy()
-    anomalies_df.reset_index(inplace=True)
-    anomalies_df.rename(columns={'index': 'Index original'}, inplace=True)
-    
-    # Comptage des anomalies pour le résumé
-    anomaly_counter = anomalies_df['Anomalie'].str.split(' / ').explode().value_counts()
-    
-    return anomalies_df, anomaly_counter
+def tache_courante(cle_controles):
+    """
+    Suivi de la tâche de fond de la session pour les contrôles donnés, ou None.
+    """
+    suivi = st.session_state.get('tache')
+    return suivi if suivi is not None and suivi['cle'] == cle_controles else None
 
-def afficher_resume_anomalies(anomaly_counter):
+@st.fragment(run_every=1.0)
+def suivre_tache(tache, nb_resultats):
     """
-    Affiche un résumé des anomalies.
+    Affiche la progression de chaque étape d'une tâche en cours et permet
+    de l'annuler. La page est réaffichée dès qu'un résultat est publié ou
+    que la tâche se termine.
     """
-    if not anomaly_counter.empty:
-        summary_df = pd.DataFrame(anomaly_counter).reset_index()
-        summary_df.columns = ["Type d'anomalie", "Nombre de cas"]
-        st.subheader("Récapitulatif des anomalies")
-        st.dataframe(summary_df)
+    if not tache.active or len(tache.resultats) != nb_resultats:
+        st.rerun()
+    for etape, fraction in tache.progression.items():
+        st.progress(fraction, text=f"{etape} : {fraction:.0%}")
+    if st.button("Annuler les contrôles"):
+        tache.annuler()
+        st.rerun()
+
+def afficher_bilan_historique(bilan):
+    """
+    Affiche l'évolution des anomalies par rapport au contrôle précédent.
+    """
+    if bilan.reference is None:
+        st.info("Premier contrôle enregistré pour ce référentiel : l'évolution sera affichée au prochain contrôle.")
+        return
+    st.info(f"Comparaison au contrôle du {bilan.reference.get('date', '?')} ({bilan.reference.get('fichier') or 'fichier inconnu'}) : "
+            f"{bilan.lignes_reprises} ligne(s) inchangée(s) reprise(s), {bilan.lignes_controlees} ligne(s) nouvelle(s) ou modifiée(s) contrôlée(s).")
+    st.subheader("Évolution des anomalies")
+    if bilan.evolution.empty:
+        st.write("Aucune anomalie, ni avant ni maintenant.")
+    else:
+        st.dataframe(bilan.evolution)
+
+def afficher_mesures(mesures, nom_fichier):
+    """
+    Affiche les mesures de performance des étapes exécutées pour le fichier
+    courant et propose leur téléchargement en lignes JSON.
+    """
+    with st.expander("Performance"):
+        if not mesures.etapes:
+            st.write("Aucune étape mesurée : les résultats proviennent du cache.")
+            return
+        st.dataframe(mesures.to_dataframe())
+        st.download_button(
+            label="Télécharger les mesures (JSON)",
+            data=mesures.lignes_journal(fichier=nom_fichier),
+            file_name='mesures_radioreleve.jsonl',
+            mime='application/x-ndjson',
+        )
 
 # --- Interface Streamlit ---
 st.title("Contrôle des données de Radiorelève")
 st.markdown("Veuillez téléverser votre fichier pour lancer les contrôles.")
 
-uploaded_file = st.file_uploader("Choisissez un fichier", type=['csv', 'xlsx'])
+uploaded_file = st.file_uploader("Choisissez un fichier", type=extensions)
 
 if uploaded_file is not None:
     st.success("Fichier chargé avec succès !")
 
+    cache = cache_resultats()
+    empreinte = empreinte_fichier(uploaded_file)
+
+    # Mesures de performance des étapes exécutées, conservées tant que le fichier ne change pas
+    if st.session_state.get('mesures_empreinte') != empreinte:
+        st.session_state['mesures_empreinte'] = empreinte
+        st.session_state['mesures'] = Mesures()
+    mesures = st.session_state['mesures']
+
     try:
-        file_extension = uploaded_file.name.split('.')[-1]
-        
-        dtype_mapping = {
-            'Numéro de branchement': str,
-            'Abonnement': str
-        }
+        file_extension = extension_fichier(uploaded_file.name)
 
+        mode_flux = False
         if file_extension == 'csv':
-            delimiter = get_csv_delimiter(uploaded_file)
-            df = pd.read_csv(uploaded_file, sep=delimiter, dtype=dtype_mapping)
-        elif file_extension == 'xlsx':
-            df = pd.read_excel(uploaded_file, dtype=dtype_mapping)
-        else:
-            st.error("Format de fichier non pris en charge. Veuillez utiliser un fichier .csv ou .xlsx.")
-            st.stop()
+            # Proposé d'office lorsque le fichier dépasse à lui seul le budget de mémoire des contrôles
+            mode_flux = st.checkbox("Mode flux pour les fichiers volumineux (lecture par blocs)",
+                                    value=uploaded_file.size > BUDGET_MEMOIRE)
+
+        # Suivi des anomalies d'un contrôle à l'autre, hors mode flux
+        referentiel = None
+        if not mode_flux and st.checkbox("Comparer au contrôle précédent (seules les lignes nouvelles ou modifiées sont contrôlées)"):
+            referentiel = st.text_input("Nom du référentiel", value='radioreleve').strip() or None
+
+        # Seules les colonnes contrôlées et les colonnes choisies ici sont chargées
+        # Les clés du cache portent la version de la lecture, le cache sur disque survivant aux mises à jour
+        colonnes = cache.get((empreinte, VERSION_LECTURE, 'colonnes'))
+        if colonnes is None:
+            colonnes = cache.put((empreinte, VERSION_LECTURE, 'colonnes'), colonnes_fichier(uploaded_file, file_extension))
+        colonnes_supplementaires = [col for col in colonnes if col not in colonnes_chargees]
+        selection = st.multiselect(
+            "Colonnes supplémentaires à conserver dans le rapport",
+            colonnes_supplementaires,
+            default=[] if file_extension in formats_colonnes else colonnes_supplementaires,
+        )
+        colonnes_conservees = tuple(selection)
+        if file_extension not in formats_colonnes and len(selection) == len(colonnes_supplementaires):
+            # Toutes les colonnes sont conservées : le fichier est lu sans élagage
+            colonnes_conservees = None
+
+        # Un fichier au contenu identique n'est lu qu'une seule fois
+        cle_lecture = (empreinte, VERSION_LECTURE, 'lecture', mode_flux, colonnes_conservees)
+        lecture = cache.get(cle_lecture)
+        if lecture is None:
+            if mode_flux:
+                # Seul l'aperçu est lu ici, le fichier complet est lu par blocs lors des contrôles
+                encodage, delimiter, _ = detecter_format_csv(uploaded_file)
+                lecture = (pd.read_csv(uploaded_file, sep=delimiter, encoding=encodage, dtype=dtypes_lecture,
+                                       usecols=colonnes_lues(colonnes, colonnes_conservees), nrows=5), delimiter)
+                uploaded_file.seek(0)
+            else:
+                lecture = lire_fichier(uploaded_file, file_extension, mesures, colonnes_conservees)
+            cache.put(cle_lecture, lecture)
+        df, delimiter = lecture
     except Exception as e:
         st.error(f"Erreur de lecture du fichier : {e}")
         st.stop()
@@ -265,250 +291,92 @@ if uploaded_file is not None:
     st.subheader("Aperçu des 5 premières lignes")
     st.dataframe(df.head())
 
+    # Les résultats restent affichés lors des réexécutions suivantes (filtre, téléchargement)
+    cle_controles = (empreinte, VERSION_REGLES, VERSION_LECTURE, mode_flux, colonnes_conservees, referentiel)
+    archive = st.checkbox("Proposer aussi une archive ZIP des anomalies (une liste par type d'anomalie et récapitulatif)")
     if st.button("Lancer les contrôles"):
-        st.write("Contrôles en cours...")
-        anomalies_df, anomaly_counter = check_data(df)
+        st.session_state['controles'] = cle_controles
+        # Un nouveau lancement remplace une tâche terminée, annulée ou en échec
+        suivi = tache_courante(cle_controles)
+        if suivi is not None and not suivi['tache'].active:
+            st.session_state.pop('tache')
+
+    if st.session_state.get('controles') == cle_controles:
+        resultats = cache.get(cle_controles + ('controles',))
+        rapports_manquants = [format_rapport for format_rapport in formats_rapport(file_extension, archive)
+                              if cache.get(cle_controles + (format_rapport,)) is None]
+        suivi = tache_courante(cle_controles)
+        if suivi is None and (resultats is None or (rapports_manquants and not resultats[0].empty)):
+            # Les contrôles et les rapports manquants sont produits en tâche de fond
+            # Une tâche en cours pour un autre fichier ou d'autres options est annulée
+            if st.session_state.get('tache') is not None:
+                st.session_state['tache']['tache'].annuler()
+            precedent, colonnes_modifiees = (None, None)
+            if resultats is None and not mode_flux and not referentiel:
+                precedent, colonnes_modifiees = controle_precedent(cache, df, colonnes_conservees)
+            tache = gestionnaire_taches().lancer(
+                ['Contrôles'] + [RAPPORTS[format_rapport][0] for format_rapport in rapports_manquants],
+                executer_controles, cache, cle_controles, df, resultats, rapports_manquants,
+                fichier=io.BytesIO(uploaded_file.getvalue()) if mode_flux else None,
+                nom_fichier=uploaded_file.name, delimiter=delimiter,
+                usecols=colonnes_lues(colonnes, colonnes_conservees), referentiel=referentiel,
+                precedent=precedent, colonnes_modifiees=colonnes_modifiees,
+            )
+            suivi = st.session_state['tache'] = {'cle': cle_controles, 'tache': tache, 'mesures_reprises': False}
+        tache = None if suivi is None else suivi['tache']
+
+        if tache is not None:
+            if tache.active:
+                suivre_tache(tache, len(tache.resultats))
+            if not tache.active and not suivi['mesures_reprises']:
+                mesures.etapes.extend(tache.etapes)
+                suivi['mesures_reprises'] = True
+            if resultats is None:
+                resultats = tache.resultats.get('controles')
+            if tache.etat == ANNULEE and resultats is None:
+                st.warning("Contrôles annulés.")
+                st.stop()
+            elif tache.etat == ECHEC:
+                # L'erreur est affichée même si les contrôles ont abouti et que seul un rapport a échoué
+                st.error(message_erreur(tache))
+        if resultats is None:
+            st.stop()
+        if not mode_flux and not referentiel:
+            st.session_state['dernier_controle'] = empreinte
+        anomalies_df, anomaly_counter, anomaly_index = resultats
+
+        bilan = cache.get(cle_controles + ('bilan',)) or (tache.resultats.get('bilan') if tache is not None else None)
+        if bilan is not None:
+            afficher_bilan_historique(bilan)
 
         if not anomalies_df.empty:
             st.error("Anomalies détectées !")
-            anomalies_df_display = anomalies_df.drop(columns=['Anomalie Détaillée FP2E'])
-            st.dataframe(anomalies_df_display)
+            anomalies_df_display = colonnes_affichees(anomalies_df)
+            type_affiche = st.selectbox("Filtrer par type d'anomalie", ["Toutes les anomalies"] + list(anomaly_index))
+            if type_affiche == "Toutes les anomalies":
+                st.dataframe(anomalies_df_display)
+            else:
+                st.dataframe(anomalies_df_display.iloc[anomaly_index[type_affiche]])
             afficher_resume_anomalies(anomaly_counter)
-            
-            anomaly_columns_map = {
-                "Protocole Radio manquant": ['Protocole Radio'],
-                "Marque manquante": ['Marque'],
-                "Numéro de compteur manquant": ['Numéro de compteur'],
-                "Numéro de tête manquant": ['Numéro de tête'],
-                "Coordonnées GPS non numériques": ['Latitude', 'Longitude'],
-                "Coordonnées GPS invalides": ['Latitude', 'Longitude'],
-                "Diamètre manquant": ['Diametre'],
-                "Année de fabrication manquante": ['Année de fabrication'],
-                
-                "KAMSTRUP: Compteur ≠ 8 caractères": ['Numéro de compteur'],
-                "KAMSTRUP: Compteur ≠ Tête": ['Numéro de compteur', 'Numéro de tête'],
-                "KAMSTRUP: Compteur ou Tête non numérique": ['Numéro de compteur', 'Numéro de tête'],
-                "KAMSTRUP: Diamètre hors plage": ['Diametre'],
-                "KAMSTRUP: Protocole ≠ WMS": ['Protocole Radio'],
-                "SAPPEL: Tête DME ≠ 15 caractères": ['Numéro de tête'],
-                "SAPPEL: Compteur ne commence pas par C ou H": ['Numéro de compteur'],
-                "SAPPEL: Incohérence Marque/Compteur (C)": ['Numéro de compteur'],
-                "SAPPEL: Incohérence Marque/Compteur (H)": ['Marque', 'Numéro de compteur'],
-                "SAPPEL: Année >22 & Tête ≠ DME": ['Année de fabrication', 'Numéro de tête'],
-                "SAPPEL: Année >22 & Protocole ≠ OMS": ['Année de fabrication', 'Protocole Radio'],
-                "ITRON: Compteur ne commence pas par I ou D": ['Numéro de compteur'],
-                "Le numéro de compteur n'est pas conforme": ['Numéro de compteur'],
-                "Le diamètre n'est pas conforme": ['Diametre'],
-                "L'année de millésime n'est pas conforme": ['Année de fabrication'],
-            }
-
-            if file_extension == 'csv':
-                csv_file = anomalies_df_display.to_csv(index=False, sep=delimiter).encode('utf-8')
-                st.download_button(
-                    label="Télécharger les anomalies en CSV",
-                    data=csv_file,
-                    file_name='anomalies_radioreleve.csv',
-                    mime='text/csv',
-                )
-            elif file_extension == 'xlsx':
-                excel_buffer = io.BytesIO()
-                
-                wb = Workbook()
-                
-                if "Sheet" in wb.sheetnames:
-                    wb.remove(wb["Sheet"])
-                
-                ws_summary = wb.create_sheet(title="Récapitulatif", index=0)
-                
-                ws_all_anomalies = wb.create_sheet(title="Toutes_Anomalies", index=1)
-                for r_df_idx, row_data in enumerate(dataframe_to_rows(anomalies_df_display, index=False, header=True)):
-                    ws_all_anomalies.append(row_data)
-
-                header_font = Font(bold=True)
-                red_fill = PatternFill(start_color='FFC7CE', end_color='FFC7CE', fill_type='solid')
-
-                for cell in ws_all_anomalies[1]:
-                    cell.font = header_font
-
-                for row_num_all, df_row in enumerate(anomalies_df.iterrows()):
-                    anomalies = str(df_row[1]['Anomalie']).split(' / ')
-                    
-                    # Logique de coloration basée sur la nouvelle logique FP2E
-                    if 'Le diamètre n\'est pas conforme' in anomalies:
-                        try:
-                            col_index = list(anomalies_df_display.columns).index('Diametre') + 1
-                            cell = ws_all_anomalies.cell(row=row_num_all + 2, column=col_index)
-                            cell.fill = red_fill
-                        except ValueError:
-                            pass
-                    
-                    if 'L\'année de millésime n\'est pas conforme' in anomalies:
-                        try:
-                            col_index = list(anomalies_df_display.columns).index('Année de fabrication') + 1
-                            cell = ws_all_anomalies.cell(row=row_num_all + 2, column=col_index)
-                            cell.fill = red_fill
-                        except ValueError:
-                            pass
-                            
-                    if 'Le numéro de compteur n\'est pas conforme' in anomalies:
-                        try:
-                            col_index = list(anomalies_df_display.columns).index('Numéro de compteur') + 1
-                            cell = ws_all_anomalies.cell(row=row_num_all + 2, column=col_index)
-                            cell.fill = red_fill
-                        except ValueError:
-                            pass
-
-                    # Coloration pour les autres anomalies
-                    for anomaly in anomalies:
-                        anomaly_key = anomaly.strip()
-                        if anomaly_key in anomaly_columns_map:
-                            columns_to_highlight = anomaly_columns_map[anomaly_key]
-                            for col_name in columns_to_highlight:
-                                try:
-                                    col_index = list(anomalies_df_display.columns).index(col_name) + 1
-                                    cell = ws_all_anomalies.cell(row=row_num_all + 2, column=col_index)
-                                    cell.fill = red_fill
-                                except ValueError:
-                                    pass
-
-                for col in ws_all_anomalies.columns:
-                    max_length = 0
-                    column = col[0].column
-                    for cell in col:
-                        try:
-                            if len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = (max_length + 2)
-                    ws_all_anomalies.column_dimensions[get_column_letter(column)].width = adjusted_width
-
-                title_font = Font(bold=True, size=16)
-                
-                ws_summary['A1'] = "Récapitulatif des anomalies"
-                ws_summary['A1'].font = title_font
-                
-                ws_summary.append([])
-                ws_summary.append(["Type d'anomalie", "Nombre de cas"])
-                ws_summary['A3'].font = header_font
-                ws_summary['B3'].font = header_font
-                
-                created_sheet_names = set(["Récapitulatif", "Toutes_Anomalies"])
-
-                row_num_all_anomalies = ws_summary.max_row + 1
-                ws_summary.cell(row=row_num_all_anomalies, column=1, value="Toutes les anomalies").hyperlink = f"#Toutes_Anomalies!A1"
-                ws_summary.cell(row=row_num_all_anomalies, column=1).font = Font(underline="single", color="0563C1")
-                ws_summary.cell(row=row_num_all_anomalies, column=2, value=len(anomalies_df))
-                ws_summary.cell(row=row_num_all_anomalies, column=2).alignment = Alignment(horizontal="right")
-                
-                for r_idx, (anomaly_type, count) in enumerate(anomaly_counter.items()):
-                    # Logique pour raccourcir le nom de la feuille
-                    if len(anomaly_type) > 28:
-                        sheet_name_base = anomaly_type[:28]
+
+            # Chaque rapport est proposé dès qu'il est prêt, le CSV avant le classeur Excel et l'archive
+            for format_rapport in formats_rapport(file_extension, archive):
+                etape, libelle, nom_rapport, mime = RAPPORTS[format_rapport]
+                contenu = cache.get(cle_controles + (format_rapport,))
+                if contenu is None and tache is not None:
+                    contenu = tache.resultats.get(format_rapport)
+                if contenu is None:
+                    if tache is not None and tache.active:
+                        st.caption(f"{etape} en cours de préparation...")
+                    elif tache is not None and tache.etat == ECHEC and tache.etape_echec == etape:
+                        st.caption(f"{etape} non produit : {tache.erreur}")
+                    elif tache is not None and tache.etat == ECHEC:
+                        st.caption(f"{etape} non produit : la tâche s'est arrêtée à l'étape {tache.etape_echec}.")
                     else:
-                        sheet_name_base = anomaly_type
-                    
-                    sheet_name = re.sub(r'[\\/?*\[\]:()\'"<>|]', '', sheet_name_base)
-                    sheet_name = sheet_name.replace(' ', '_').replace('.', '').strip()
-                    
-                    original_sheet_name = sheet_name
-                    counter = 1
-                    while sheet_name in created_sheet_names:
-                        sheet_name = f"{original_sheet_name[:28]}_{counter}"
-                        counter += 1
-                    created_sheet_names.add(sheet_name)
-
-                    row_num = ws_summary.max_row + 1
-                    ws_summary.cell(row=row_num, column=1, value=anomaly_type)
-                    ws_summary.cell(row=row_num, column=2, value=count)
-                    
-                    ws_anomaly_detail = wb.create_sheet(title=sheet_name)
-                    
-                    filtered_df = anomalies_df[anomalies_df['Anomalie'].str.contains(anomaly_type, regex=False)]
-                    
-                    for r_df_idx, row_data in enumerate(dataframe_to_rows(filtered_df.drop(columns=['Anomalie Détaillée FP2E']), index=False, header=True)):
-                        ws_anomaly_detail.append(row_data)
-
-                    for cell in ws_anomaly_detail[1]:
-                        cell.font = header_font
-                    
-                    for row_num_detail, df_row in enumerate(filtered_df.iterrows()):
-                        anomalies = str(df_row[1]['Anomalie']).split(' / ')
-
-                        # Logique de coloration basée sur la nouvelle logique FP2E
-                        if 'Le diamètre n\'est pas conforme' in anomalies:
-                            try:
-                                col_index = list(anomalies_df_display.columns).index('Diametre') + 1
-                                cell = ws_anomaly_detail.cell(row=row_num_detail + 2, column=col_index)
-                                cell.fill = red_fill
-                            except ValueError:
-                                pass
-                        
-                        if 'L\'année de millésime n\'est pas conforme' in anomalies:
-                            try:
-                                col_index = list(anomalies_df_display.columns).index('Année de fabrication') + 1
-                                cell = ws_anomaly_detail.cell(row=row_num_detail + 2, column=col_index)
-                                cell.fill = red_fill
-                            except ValueError:
-                                pass
-                                
-                        if 'Le numéro de compteur n\'est pas conforme' in anomalies:
-                            try:
-                                col_index = list(anomalies_df_display.columns).index('Numéro de compteur') + 1
-                                cell = ws_anomaly_detail.cell(row=row_num_detail + 2, column=col_index)
-                                cell.fill = red_fill
-                            except ValueError:
-                                pass
-
-                        # Coloration pour les autres anomalies
-                        for anomaly in anomalies:
-                            anomaly_key = anomaly.strip()
-                            if anomaly_key in anomaly_columns_map:
-                                columns_to_highlight = anomaly_columns_map[anomaly_key]
-                                for col_name in columns_to_highlight:
-                                    try:
-                                        col_index = list(anomalies_df_display.columns).index(col_name) + 1
-                                        cell = ws_anomaly_detail.cell(row=row_num_detail + 2, column=col_index)
-                                        cell.fill = red_fill
-                                    except ValueError:
-                                        pass
-
-                    for col in ws_anomaly_detail.columns:
-                        max_length = 0
-                        column = col[0].column
-                        for cell in col:
-                            try:
-                                if len(str(cell.value)) > max_length:
-                                    max_length = len(str(cell.value))
-                            except:
-                                pass
-                        adjusted_width = (max_length + 2)
-                        ws_anomaly_detail.column_dimensions[get_column_letter(column)].width = adjusted_width
-
-                    ws_summary.cell(row=row_num, column=1).hyperlink = f"#{sheet_name}!A1"
-                    ws_summary.cell(row=row_num, column=1).font = Font(underline="single", color="0563C1")
-                    
-                for col in ws_summary.columns:
-                    max_length = 0
-                    column = col[0].column
-                    for cell in col:
-                        try:
-                            if len(str(cell.value)) > max_length:
-                                max_length = len(str(cell.value))
-                        except:
-                            pass
-                    adjusted_width = (max_length + 2)
-                    ws_summary.column_dimensions[get_column_letter(column)].width = adjusted_width
-                    
-                excel_buffer_styled = io.BytesIO()
-                wb.save(excel_buffer_styled)
-                excel_buffer_styled.seek(0)
-
-                st.download_button(
-                    label="Télécharger les anomalies en Excel",
-                    data=excel_buffer_styled,
-                    file_name='anomalies_radioreleve.xlsx',
-                    mime='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                )
+                        st.caption(f"{etape} non produit : relancez les contrôles.")
+                    continue
+                st.download_button(label=libelle, data=contenu, file_name=nom_rapport, mime=mime)
         else:
             st.success("Aucune anomalie détectée. Les données sont conformes.")
+
+    afficher_mesures(mesures, uploaded_file.name)
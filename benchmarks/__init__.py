@@ -0,0 +1,3 @@
+"""
+Jeux de données synthétiques et mesures de performance des contrôles.
+"""
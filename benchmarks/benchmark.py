@@ -0,0 +1,182 @@
+"""
+Mesure des performances des contrôles sur des jeux de données synthétiques.
+
+Pour chaque taille demandée, le jeu de données est généré puis chaque étape
+est chronométrée et son pic de mémoire résidente relevé :
+lecture CSV/XLSX, normalisation, chaque famille de règles, contrôle complet
+et exports CSV/XLSX. Les résultats sont écrits au format JSON pour être
+comparés d'une version à l'autre.
+
+Exemple :
+    python -m benchmarks.benchmark --lignes 10000 100000 1000000 --sortie resultats.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from controle import (
+    REGLES, VERSION_REGLES, check_data, ecrire_rapport_csv, ecrire_rapport_excel,
+    evaluer_regles, lire_fichier, memoire_processus
+)
+from controle.regles import normaliser_donnees
+from benchmarks.synthese import generer_donnees, lire_repartition
+
+# Au-delà, la lecture et l'export Excel ne sont pas mesurés (openpyxl traite
+# environ 1 000 lignes par seconde en lecture, et une feuille est limitée à 1 048 576 lignes)
+LIGNES_MAX_EXCEL = 100_000
+
+FAMILLES_MARQUES = ('kamstrup', 'sappel', 'itron', 'fp2e')
+
+def famille_regle(regle):
+    """
+    Famille d'une règle : règles transverses (qui comparent les lignes entre
+    elles), marque concernée, FP2E ou règles générales.
+    """
+    if regle.transverse:
+        return 'transverses'
+    prefixe = regle.id.split('_')[0]
+    return prefixe if prefixe in FAMILLES_MARQUES else 'generales'
+
+def familles_regles():
+    """
+    Règles du registre regroupées par famille, dans l'ordre du registre.
+    """
+    familles = {}
+    for regle in REGLES:
+        familles.setdefault(famille_regle(regle), []).append(regle)
+    return familles
+
+# Intervalle d'échantillonnage de la mémoire résidente, en secondes
+INTERVALLE_ECHANTILLONNAGE = 0.001
+
+def mesurer(fonction, *args, memoire=True):
+    """
+    Exécute fonction(*args) et renvoie son résultat, sa durée en secondes et
+    le pic de mémoire pendant l'appel, en Mo (None si memoire est faux).
+    Le pic est l'augmentation maximale de la mémoire résidente du processus,
+    échantillonnée par un fil d'exécution pendant l'appel : il comprend les
+    tampons Arrow des colonnes texte, alloués hors de l'allocateur Python et
+    donc invisibles pour tracemalloc. Si la mémoire résidente n'est pas
+    disponible (hors Linux), le pic est relevé par tracemalloc lors d'une
+    seconde exécution, tracemalloc ralentissant fortement pandas.
+    """
+    if memoire:
+        gc.collect()
+        pa.default_memory_pool().release_unused()
+    depart_memoire = memoire_processus() if memoire else None
+    pic = [depart_memoire]
+    fin = threading.Event()
+
+    def echantillonner():
+        while not fin.wait(INTERVALLE_ECHANTILLONNAGE):
+            pic[0] = max(pic[0], memoire_processus())
+
+    echantillonneur = threading.Thread(target=echantillonner, daemon=True)
+    if depart_memoire is not None:
+        echantillonneur.start()
+    depart = time.perf_counter()
+    try:
+        resultat = fonction(*args)
+    finally:
+        duree = time.perf_counter() - depart
+        fin.set()
+    if not memoire:
+        return resultat, duree, None
+    if depart_memoire is not None:
+        echantillonneur.join()
+        return resultat, duree, (max(pic[0], memoire_processus()) - depart_memoire) / 2**20
+    tracemalloc.start()
+    fonction(*args)
+    pic_trace = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return resultat, duree, pic_trace / 2**20
+
+def mesurer_taille(nb_lignes, repartition_marques, taux_anomalies, graine, repertoire, memoire=True):
+    """
+    Mesure toutes les étapes pour un jeu de données de nb_lignes lignes et
+    renvoie la liste des mesures.
+    """
+    mesures = []
+    def enregistrer(etape, fonction, *args):
+        resultat, duree, pic = mesurer(fonction, *args, memoire=memoire)
+        mesures.append({'lignes': nb_lignes, 'etape': etape, 'duree_s': round(duree, 4),
+                        'memoire_pic_mo': None if pic is None else round(pic, 1)})
+        print(f"{nb_lignes:>10} {etape:<22} {duree:>9.3f} s" + ('' if pic is None else f" {pic:>9.1f} Mo"), flush=True)
+        return resultat
+
+    df = generer_donnees(nb_lignes, repartition_marques, taux_anomalies, graine)
+
+    chemin_csv = os.path.join(repertoire, f'donnees_{nb_lignes}.csv')
+    df.to_csv(chemin_csv, index=False, sep=';')
+    df_lu, _ = enregistrer('lecture_csv', lire_fichier, chemin_csv, 'csv')
+    if nb_lignes <= LIGNES_MAX_EXCEL:
+        chemin_xlsx = os.path.join(repertoire, f'donnees_{nb_lignes}.xlsx')
+        df.to_excel(chemin_xlsx, index=False)
+        enregistrer('lecture_xlsx', lire_fichier, chemin_xlsx, 'xlsx')
+    del df
+
+    df_normalise = enregistrer('normalisation', normaliser_donnees, df_lu)
+    for famille, regles in familles_regles().items():
+        enregistrer(f'regles_{famille}', evaluer_regles, df_normalise, regles)
+    del df_normalise
+
+    anomalies_df, _, anomaly_index = enregistrer('controle_complet', check_data, df_lu)
+    mesures[-1]['lignes_en_anomalie'] = len(anomalies_df)
+
+    enregistrer('export_csv', ecrire_rapport_csv, anomalies_df, os.path.join(repertoire, 'anomalies.csv'), ';')
+    if len(anomalies_df) <= LIGNES_MAX_EXCEL:
+        enregistrer('export_xlsx', ecrire_rapport_excel, anomalies_df, anomaly_index, os.path.join(repertoire, 'anomalies.xlsx'))
+    return mesures
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.benchmark', description="Mesure les performances des contrôles de radiorelève.")
+    parser.add_argument('--lignes', type=int, nargs='+', default=[10_000, 100_000], help="Tailles des jeux de données (défaut : 10000 100000)")
+    parser.add_argument('--marques', type=lire_repartition, default=None, help="Répartition des marques, ex. 'KAMSTRUP=0.5,ITRON=0.5'")
+    parser.add_argument('--taux-anomalies', type=float, default=0.05, help="Part des lignes en anomalie (défaut : 0.05)")
+    parser.add_argument('--graine', type=int, default=0, help="Graine du générateur aléatoire")
+    parser.add_argument('--sans-memoire', action='store_true', help="Ne pas mesurer le pic de mémoire")
+    parser.add_argument('--sortie', default='resultats_benchmark.json', help="Fichier JSON des résultats")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    mesures = []
+    with tempfile.TemporaryDirectory() as repertoire:
+        for nb_lignes in args.lignes:
+            mesures.extend(mesurer_taille(nb_lignes, args.marques, args.taux_anomalies, args.graine, repertoire, not args.sans_memoire))
+
+    resultats = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'version_regles': VERSION_REGLES,
+        'environnement': {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'plateforme': platform.platform(),
+            'processeurs': os.cpu_count(),
+        },
+        'parametres': {
+            'marques': args.marques,
+            'taux_anomalies': args.taux_anomalies,
+            'graine': args.graine,
+        },
+        'mesures': mesures,
+    }
+    with open(args.sortie, 'w', encoding='utf-8') as f:
+        json.dump(resultats, f, ensure_ascii=False, indent=2)
+    print(f"Résultats écrits dans {args.sortie}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""
+Génération de jeux de données de radiorelève synthétiques.
+
+Les lignes sont conformes aux règles de contrôle, puis une part d'entre
+elles (taux_anomalies) est altérée pour déclencher les différentes
+anomalies. La génération est entièrement vectorisée et permet de produire
+de 10 000 à 10 000 000 de lignes.
+
+Exemple :
+    python -m benchmarks.synthese --lignes 1000000 --sortie donnees.csv
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from controle.regles import diametre_lettre
+
+# Répartition par défaut des marques
+REPARTITION_MARQUES = {
+    'KAMSTRUP': 0.25,
+    'SAPPEL (C)': 0.25,
+    'SAPPEL (H)': 0.15,
+    'ITRON': 0.25,
+    'DIEHL': 0.10,
+}
+
+# Part des compteurs relevés manuellement
+TAUX_MANUELLE = 0.05
+
+# Altérations appliquées aux lignes en anomalie
+ALTERATIONS = [
+    'protocole_vide', 'marque_vide', 'compteur_vide', 'diametre_vide', 'tete_vide',
+    'gps_texte', 'gps_zero', 'annee_fp2e', 'lettre_fp2e', 'kamstrup_tete', 'prefixe',
+    'compteur_doublon', 'gps_partage', 'gps_eloigne',
+]
+
+NB_COMMUNES = 200
+
+def _chiffres(rng, nb_lignes, nb_chiffres):
+    """
+    Chaînes de nb_chiffres chiffres aléatoires, construites par morceaux de
+    trois chiffres à partir d'une table de correspondance.
+    """
+    table = np.array([f"{i:03d}" for i in range(1000)], dtype=object)
+    resultat = np.full(nb_lignes, '', dtype=object)
+    while nb_chiffres > 0:
+        morceau = min(nb_chiffres, 3)
+        resultat = resultat + np.array([s[-morceau:] for s in table], dtype=object)[rng.integers(0, 1000, nb_lignes)]
+        nb_chiffres -= morceau
+    return resultat
+
+def generer_donnees(nb_lignes, repartition_marques=None, taux_anomalies=0.05, graine=0):
+    """
+    Génère un DataFrame de nb_lignes lignes au format des exports de
+    radiorelève, avec la répartition de marques donnée (marque -> part) et
+    une part taux_anomalies de lignes en anomalie.
+    """
+    rng = np.random.default_rng(graine)
+    repartition_marques = repartition_marques or REPARTITION_MARQUES
+    marques = np.array(list(repartition_marques), dtype=object)
+    parts = np.array(list(repartition_marques.values()), dtype=float)
+    marque = marques[rng.choice(len(marques), size=nb_lignes, p=parts / parts.sum())]
+
+    is_kamstrup = marque == 'KAMSTRUP'
+    is_sappel_c = marque == 'SAPPEL (C)'
+    is_sappel_h = marque == 'SAPPEL (H)'
+    is_sappel = is_sappel_c | is_sappel_h
+    is_itron = marque == 'ITRON'
+
+    manuelle = rng.random(nb_lignes) < TAUX_MANUELLE
+    mode = np.where(manuelle, 'Manuelle', 'Radio').astype(object)
+
+    annee = rng.integers(2012, 2026, nb_lignes)
+    annee_texte = np.array([f"{a % 100:02d}" for a in range(100)], dtype=object)[annee % 100]
+
+    # Diamètres compatibles avec la norme FP2E et la plage KAMSTRUP
+    diametres = np.array([15, 15, 15, 20, 25, 30, 40, 50, 65, 80])
+    diametre = diametres[rng.integers(0, len(diametres), nb_lignes)]
+    lettres = {d: lettres_d[0] for d, lettres_d in diametre_lettre.items()}
+    lettre_diametre = np.vectorize(lettres.get, otypes=[object])(diametre)
+
+    # Numéros de compteur : 8 chiffres pour KAMSTRUP, format FP2E pour SAPPEL, I/D pour ITRON
+    compteur = _chiffres(rng, nb_lignes, 8)
+    classe = np.array(list('ABCDEFGHJKLMNPRSTVWXYZ'), dtype=object)[rng.integers(0, 22, nb_lignes)]
+    fp2e = np.where(is_sappel_h, 'H', 'C').astype(object) + annee_texte + classe + lettre_diametre + _chiffres(rng, nb_lignes, 6)
+    compteur = np.where(is_sappel, fp2e, compteur)
+    itron = np.array(['I', 'D'], dtype=object)[rng.integers(0, 2, nb_lignes)] + _chiffres(rng, nb_lignes, 9)
+    compteur = np.where(is_itron, itron, compteur)
+
+    # Numéros de tête : identique au compteur pour KAMSTRUP, DME sur 15 caractères pour SAPPEL
+    tete = _chiffres(rng, nb_lignes, 10)
+    tete = np.where(is_kamstrup, compteur, tete)
+    tete = np.where(is_sappel, 'DME' + _chiffres(rng, nb_lignes, 12), tete)
+    tete = np.where(manuelle & ~is_kamstrup & ~is_sappel, '', tete)
+
+    protocole = np.where(is_kamstrup, 'WMS', 'OMS').astype(object)
+    protocole = np.where(manuelle & ~is_kamstrup & ~is_sappel, '', protocole)
+
+    # Communes réparties sur la France métropolitaine, compteurs à quelques kilomètres du centre
+    centres_lat = rng.uniform(43.0, 50.5, NB_COMMUNES)
+    centres_lon = rng.uniform(-1.5, 7.0, NB_COMMUNES)
+    commune_id = rng.integers(0, NB_COMMUNES, nb_lignes)
+    communes = np.array([f"COMMUNE {i:03d}" for i in range(NB_COMMUNES)], dtype=object)
+    latitude = np.round(centres_lat[commune_id] + rng.normal(0, 0.02, nb_lignes), 6).astype(object)
+    longitude = np.round(centres_lon[commune_id] + rng.normal(0, 0.03, nb_lignes), 6).astype(object)
+
+    df = pd.DataFrame({
+        'Numéro de branchement': _chiffres(rng, nb_lignes, 9),
+        'Abonnement': _chiffres(rng, nb_lignes, 7),
+        'Commune': communes[commune_id],
+        'Marque': marque,
+        'Protocole Radio': protocole,
+        'Mode de relève': mode,
+        'Numéro de compteur': compteur,
+        'Numéro de tête': tete,
+        'Latitude': latitude,
+        'Longitude': longitude,
+        'Année de fabrication': annee,
+        'Diametre': diametre.astype(float),
+    })
+
+    # Altération d'une part des lignes pour déclencher les anomalies
+    en_anomalie = rng.random(nb_lignes) < taux_anomalies
+    alteration = np.where(en_anomalie, rng.integers(0, len(ALTERATIONS), nb_lignes), -1)
+    def lignes(nom):
+        return alteration == ALTERATIONS.index(nom)
+
+    df.loc[lignes('protocole_vide'), 'Protocole Radio'] = ''
+    df.loc[lignes('marque_vide'), 'Marque'] = ''
+    df.loc[lignes('compteur_vide'), 'Numéro de compteur'] = ''
+    df.loc[lignes('diametre_vide'), 'Diametre'] = np.nan
+    df.loc[lignes('tete_vide'), 'Numéro de tête'] = ''
+    df.loc[lignes('gps_texte'), 'Latitude'] = 'N/A'
+    df.loc[lignes('gps_zero'), ['Latitude', 'Longitude']] = 0
+    df.loc[lignes('annee_fp2e'), 'Année de fabrication'] = df.loc[lignes('annee_fp2e'), 'Année de fabrication'] - 1
+    df.loc[lignes('lettre_fp2e'), 'Diametre'] = 100.0
+    df.loc[lignes('kamstrup_tete'), 'Numéro de tête'] = _chiffres(rng, int(lignes('kamstrup_tete').sum()), 8)
+    df.loc[lignes('prefixe'), 'Numéro de compteur'] = 'X' + df.loc[lignes('prefixe'), 'Numéro de compteur'].str.slice(1)
+    # Doublons : numéro de compteur d'une autre ligne, point GPS commun à toutes les lignes altérées
+    df.loc[lignes('compteur_doublon'), 'Numéro de compteur'] = compteur[rng.integers(0, nb_lignes, int(lignes('compteur_doublon').sum()))]
+    df.loc[lignes('gps_partage'), ['Latitude', 'Longitude']] = [centres_lat[0], centres_lon[0]]
+    # Compteur placé au centre d'une autre commune
+    autre_commune = (commune_id[lignes('gps_eloigne')] + 1) % NB_COMMUNES
+    df.loc[lignes('gps_eloigne'), 'Latitude'] = centres_lat[autre_commune]
+    df.loc[lignes('gps_eloigne'), 'Longitude'] = centres_lon[autre_commune]
+
+    return df
+
+def lire_repartition(texte):
+    """
+    Lit une répartition de marques de la forme 'KAMSTRUP=0.5,ITRON=0.5'.
+    """
+    repartition = {}
+    for element in texte.split(','):
+        marque, part = element.rsplit('=', 1)
+        repartition[marque.strip()] = float(part)
+    return repartition
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.synthese', description="Génère un jeu de données de radiorelève synthétique.")
+    parser.add_argument('--lignes', type=int, default=100_000, help="Nombre de lignes (défaut : 100000)")
+    parser.add_argument('--marques', type=lire_repartition, default=None, help="Répartition des marques, ex. 'KAMSTRUP=0.5,ITRON=0.5'")
+    parser.add_argument('--taux-anomalies', type=float, default=0.05, help="Part des lignes en anomalie (défaut : 0.05)")
+    parser.add_argument('--graine', type=int, default=0, help="Graine du générateur aléatoire")
+    parser.add_argument('--sortie', default='donnees_synthetiques.csv', help="Fichier .csv ou .xlsx à écrire")
+    args = parser.parse_args(argv)
+
+    df = generer_donnees(args.lignes, args.marques, args.taux_anomalies, args.graine)
+    if args.sortie.endswith('.xlsx'):
+        df.to_excel(args.sortie, index=False)
+    else:
+        df.to_csv(args.sortie, index=False, sep=';')
+    print(f"{len(df)} lignes écrites dans {args.sortie}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+"""
+Contrôle des données de radiorelève : lecture des fichiers, règles de
+contrôle et génération des rapports, indépendamment de l'interface Streamlit.
+"""
+from .cache import CACHE_DISQUE_TAILLE_MAX, CACHE_REPERTOIRE, CACHE_TAILLE_MAX, CacheResultats, empreinte_fichier, taille_objet
+from .geographie import REFERENTIEL_COMMUNES, hors_commune, lire_referentiel_communes
+from .historique import HISTORIQUE_REPERTOIRE, BilanHistorique, Historique, check_data_incremental
+from .lecture import (
+    VERSION_LECTURE, colonnes_chargees, colonnes_fichier, colonnes_lues, detecter_encodage, detecter_format_csv,
+    dtype_mapping, dtypes_lecture, extension_fichier, extensions, formats_colonnes, get_csv_delimiter, lire_csv,
+    lire_fichier, lire_table_arrow
+)
+from .mesures import Mesures, memoire_processus, mesurer
+from .parallele import LIGNES_MIN_PARALLELE, PROCESSUS, check_data_parallele
+from .rapport import (
+    EXPORT_MEMOIRE_MAX, LIGNES_BLOC_EXPORT, colonnes_affichees, ecrire_rapport_csv, ecrire_rapport_excel,
+    ecrire_rapport_parquet, ecrire_rapport_zip, fichier_export
+)
+from .regles import (
+    ANOMALIE_BITS, ANOMALIES, BUDGET_MEMOIRE, REGLES, REGLES_TRANSVERSES, SEUIL_GPS_PARTAGE, TEXTE_ARROW,
+    VERSION_REGLES, ColonnesManquantes, Regle, anomaly_columns_map, check_data, check_data_par_blocs,
+    check_data_par_lignes, compter_anomalies, detecter_colonnes_modifiees, diametre_lettre, evaluer_regles,
+    indexer_anomalies, libelles_anomalies, lignes_par_bloc, regles_dependantes, required_columns
+)
+from .taches import (
+    ANNULEE, ECHEC, EN_ATTENTE, EN_COURS, TACHES_SIMULTANEES, TERMINEE, GestionnaireTaches, Tache, TacheAnnulee
+)
@@ -0,0 +1,152 @@
+"""
+Cache des fichiers lus, des résultats de contrôle et des exports.
+"""
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Taille maximale du cache de résultats en mémoire, et répertoire optionnel du cache sur disque
+CACHE_TAILLE_MAX = int(os.environ.get('CONTROLE_CACHE_TAILLE_MO', '1024')) * 1024 * 1024
+CACHE_REPERTOIRE = os.environ.get('CONTROLE_CACHE_REPERTOIRE')
+
+# Taille maximale des fichiers du cache sur disque
+CACHE_DISQUE_TAILLE_MAX = int(os.environ.get('CONTROLE_CACHE_DISQUE_TAILLE_MO', '10240')) * 1024 * 1024
+
+@contextmanager
+def ecriture_atomique(chemin):
+    """
+    Fichier binaire où écrire le contenu qui remplacera chemin : un fichier
+    temporaire propre à l'appel, dans le répertoire de chemin, renommé en
+    chemin une fois écrit et supprimé si l'écriture échoue. chemin n'est
+    ainsi jamais partiellement écrit, même par des écritures simultanées.
+    """
+    descripteur, temporaire = tempfile.mkstemp(dir=os.path.dirname(chemin) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(descripteur, 'wb') as f:
+            yield f
+        os.replace(temporaire, chemin)
+    except BaseException:
+        os.remove(temporaire)
+        raise
+
+def empreinte_fichier(file, taille_bloc=1024 * 1024):
+    """
+    Calcule l'empreinte SHA-256 du contenu d'un fichier, lu par blocs.
+    """
+    empreinte = hashlib.sha256()
+    file.seek(0)
+    for bloc in iter(lambda: file.read(taille_bloc), b''):
+        empreinte.update(bloc)
+    file.seek(0)
+    return empreinte.hexdigest()
+
+def taille_objet(valeur):
+    """
+    Estime la taille en mémoire d'une valeur mise en cache.
+    """
+    if isinstance(valeur, pd.DataFrame):
+        return int(valeur.memory_usage(deep=True).sum())
+    if isinstance(valeur, pd.Series):
+        return int(valeur.memory_usage(deep=True))
+    if isinstance(valeur, np.ndarray):
+        return valeur.nbytes
+    if isinstance(valeur, (bytes, bytearray, str)):
+        return len(valeur)
+    if isinstance(valeur, dict):
+        return sum(taille_objet(v) for v in valeur.values())
+    if isinstance(valeur, (tuple, list)):
+        return sum(taille_objet(v) for v in valeur)
+    return sys.getsizeof(valeur)
+
+class CacheResultats:
+    """
+    Cache LRU des fichiers lus, des résultats de contrôle et des exports,
+    indexé par l'empreinte du contenu du fichier. La taille totale en mémoire
+    est bornée par taille_max ; si repertoire est fourni, les entrées sont
+    aussi conservées sur disque et rechargées lorsqu'elles ont été évincées
+    de la mémoire. Les fichiers du répertoire sont limités à
+    taille_max_disque octets : les moins récemment utilisés sont supprimés.
+    """
+    def __init__(self, taille_max=CACHE_TAILLE_MAX, repertoire=None, taille_max_disque=CACHE_DISQUE_TAILLE_MAX):
+        self.taille_max = taille_max
+        self.repertoire = repertoire
+        self.taille_max_disque = taille_max_disque
+        self._entrees = OrderedDict()
+        self._taille = 0
+        self._verrou = threading.Lock()
+        if repertoire:
+            os.makedirs(repertoire, exist_ok=True)
+
+    def _chemin(self, cle):
+        nom = hashlib.sha256(repr(cle).encode('utf-8')).hexdigest()
+        return os.path.join(self.repertoire, f"{nom}.pkl")
+
+    def get(self, cle):
+        with self._verrou:
+            if cle in self._entrees:
+                self._entrees.move_to_end(cle)
+                return self._entrees[cle][0]
+        if self.repertoire:
+            # Le fichier peut avoir été supprimé entre-temps par un autre fil d'exécution
+            try:
+                with open(self._chemin(cle), 'rb') as f:
+                    valeur = pickle.load(f)
+                os.utime(self._chemin(cle))
+            except FileNotFoundError:
+                return None
+            self._ajouter(cle, valeur)
+            return valeur
+        return None
+
+    def put(self, cle, valeur):
+        self._ajouter(cle, valeur)
+        if self.repertoire:
+            # Plusieurs tâches peuvent écrire la même clé en même temps
+            with ecriture_atomique(self._chemin(cle)) as f:
+                pickle.dump(valeur, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self._elaguer_disque()
+        return valeur
+
+    def _elaguer_disque(self):
+        """
+        Supprime les fichiers les moins récemment utilisés du répertoire
+        jusqu'à ce que leur taille totale ne dépasse plus taille_max_disque.
+        """
+        fichiers = []
+        for entree in os.scandir(self.repertoire):
+            if entree.name.endswith('.pkl'):
+                try:
+                    etat = entree.stat()
+                except FileNotFoundError:
+                    continue
+                fichiers.append((etat.st_mtime, etat.st_size, entree.path))
+        taille = sum(taille_fichier for _, taille_fichier, _ in fichiers)
+        for _, taille_fichier, chemin in sorted(fichiers):
+            if taille <= self.taille_max_disque:
+                break
+            try:
+                os.remove(chemin)
+            except FileNotFoundError:
+                pass
+            taille -= taille_fichier
+
+    def _ajouter(self, cle, valeur):
+        taille = taille_objet(valeur)
+        with self._verrou:
+            if cle in self._entrees:
+                self._taille -= self._entrees.pop(cle)[1]
+            if taille > self.taille_max:
+                return
+            self._entrees[cle] = (valeur, taille)
+            self._taille += taille
+            while self._taille > self.taille_max:
+                _, (_, taille_evincee) = self._entrees.popitem(last=False)
+                self._taille -= taille_evincee
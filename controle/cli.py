@@ -0,0 +1,209 @@
+"""
+Validation en ligne de commande d'un lot de fichiers de radiorelève.
+
+Exemple :
+    python -m controle exports/ --sortie rapports/ --processus 8 --seuil 1000
+
+Chaque fichier est contrôlé dans un processus séparé (un fichier seul est
+réparti sur les processus, voir check_data_parallele) et donne lieu à un
+rapport d'anomalies ; un récapitulatif consolidé est écrit dans
+recapitulatif.csv.
+Code de sortie : 0 si tout est conforme au seuil, 1 si le nombre total de
+lignes en anomalie dépasse le seuil, 2 si un fichier n'a pas pu être contrôlé.
+"""
+import argparse
+import glob
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+
+from .lecture import extension_fichier, extensions, formats_colonnes, lire_fichier
+from .mesures import Mesures
+from .parallele import check_data_parallele
+from .rapport import ecrire_rapport_csv, ecrire_rapport_excel, ecrire_rapport_parquet, ecrire_rapport_zip
+from .regles import ANOMALIES, BUDGET_MEMOIRE
+
+def lister_fichiers(chemins):
+    """
+    Renvoie la liste des fichiers à contrôler à partir de répertoires,
+    de chemins de fichiers ou de motifs glob.
+    """
+    fichiers = []
+    for chemin in chemins:
+        if os.path.isdir(chemin):
+            candidats = sorted(os.path.join(chemin, nom) for nom in os.listdir(chemin))
+        else:
+            candidats = sorted(glob.glob(chemin)) or [chemin]
+        for fichier in candidats:
+            if os.path.isfile(fichier) and extension_fichier(fichier) in extensions and fichier not in fichiers:
+                fichiers.append(fichier)
+    return fichiers
+
+def noms_rapports(fichiers):
+    """
+    Nom de base du rapport de chaque fichier : son nom sans extension ou,
+    si plusieurs fichiers ont le même, son chemin relatif au répertoire
+    commun à ces fichiers (séparateurs et extension remplacés par '_').
+    Un compteur départage les noms qui resteraient identiques.
+    """
+    bases = {fichier: os.path.splitext(os.path.basename(fichier))[0] for fichier in fichiers}
+    homonymes = {}
+    for fichier, base in bases.items():
+        homonymes.setdefault(base, []).append(fichier)
+    noms = {}
+    utilises = set()
+    for fichier in fichiers:
+        groupe = homonymes[bases[fichier]]
+        nom = bases[fichier]
+        if len(groupe) > 1:
+            racine = os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in groupe])
+            nom = re.sub(r'[\\/.]', '_', os.path.relpath(os.path.abspath(fichier), racine))
+        nom_unique, numero = nom, 1
+        while nom_unique in utilises:
+            numero += 1
+            nom_unique = f"{nom}_{numero}"
+        utilises.add(nom_unique)
+        noms[fichier] = nom_unique
+    return noms
+
+def resume_fichier(chemin, mesurer_etapes=False):
+    """
+    Ligne du récapitulatif d'un fichier avant son contrôle.
+    """
+    resume = {'Fichier': chemin, 'Lignes': 0, 'Lignes en anomalie': 0, 'Rapport': '', 'Erreur': ''}
+    if mesurer_etapes:
+        resume['Mesures'] = ''
+    return resume
+
+def valider_fichier(chemin, dossier_sortie, format_rapport='auto', mesurer_etapes=False, colonnes_conservees=None,
+                    processus=1, budget=BUDGET_MEMOIRE, nom_rapport=None):
+    """
+    Contrôle un fichier et écrit son rapport d'anomalies dans dossier_sortie.
+    Renvoie la ligne du récapitulatif correspondant au fichier ; une erreur
+    de lecture ou de contrôle est reportée dans la colonne 'Erreur'.
+    Si mesurer_etapes est vrai, les mesures de performance des étapes sont
+    ajoutées au résumé sous la clé 'Mesures', en lignes de journal JSON.
+    colonnes_conservees est transmis à lire_fichier, processus et budget
+    (budget de mémoire des contrôles, en octets) à check_data_parallele.
+    nom_rapport est le nom de base du rapport (voir noms_rapports), par
+    défaut le nom du fichier sans extension.
+    """
+    resume = resume_fichier(chemin, mesurer_etapes)
+    mesures = Mesures() if mesurer_etapes else None
+    if nom_rapport is None:
+        nom_rapport = os.path.splitext(os.path.basename(chemin))[0]
+    try:
+        file_extension = extension_fichier(chemin)
+        df, delimiter = lire_fichier(chemin, file_extension, mesures, colonnes_conservees)
+        anomalies_df, anomaly_counter, anomaly_index = check_data_parallele(df, processus, mesures, budget)
+
+        if not anomalies_df.empty:
+            format_sortie = file_extension if format_rapport == 'auto' else format_rapport
+            if format_sortie in formats_colonnes:
+                format_sortie = 'parquet'
+            chemin_rapport = os.path.join(dossier_sortie, f"{nom_rapport}_anomalies.{format_sortie}")
+            if format_sortie == 'xlsx':
+                ecrire_rapport_excel(anomalies_df, anomaly_index, chemin_rapport, mesures)
+            elif format_sortie == 'parquet':
+                ecrire_rapport_parquet(anomalies_df, chemin_rapport, mesures)
+            elif format_sortie == 'zip':
+                ecrire_rapport_zip(anomalies_df, anomaly_index, chemin_rapport, delimiter or ',', mesures)
+            else:
+                ecrire_rapport_csv(anomalies_df, chemin_rapport, delimiter or ',', mesures)
+            resume['Rapport'] = chemin_rapport
+    except Exception as e:
+        resume['Erreur'] = str(e)
+        return resume
+    finally:
+        if mesures is not None:
+            resume['Mesures'] = mesures.lignes_journal(fichier=chemin)
+
+    resume['Lignes'] = len(df)
+    resume['Lignes en anomalie'] = len(anomalies_df)
+    resume.update(anomaly_counter.to_dict())
+    return resume
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m controle',
+        description="Contrôle des données de radiorelève pour un lot de fichiers CSV/XLSX/Parquet/Arrow."
+    )
+    parser.add_argument('chemins', nargs='+', help="Répertoires, fichiers ou motifs glob (ex. 'exports/*.csv')")
+    parser.add_argument('--sortie', default='rapports', help="Répertoire des rapports (défaut : rapports)")
+    parser.add_argument('--format', dest='format_rapport', choices=['auto', 'csv', 'xlsx', 'parquet', 'zip'],
+                        default='auto', help="Format des rapports ; 'auto' reprend le format du fichier contrôlé, "
+                                             "'zip' produit une archive des anomalies en CSV (une liste par type et "
+                                             "récapitulatif)")
+    parser.add_argument('--processus', type=int, default=os.cpu_count(),
+                        help="Nombre de processus de contrôle (défaut : nombre de cœurs)")
+    parser.add_argument('--budget-memoire', type=int, default=BUDGET_MEMOIRE // 2**20, metavar='MO',
+                        help="Mémoire de travail des contrôles au-delà de laquelle les lignes sont contrôlées par "
+                             "blocs, partagée entre les processus (défaut : %(default)s Mo)")
+    parser.add_argument('--seuil', type=int, default=None,
+                        help="Nombre total de lignes en anomalie au-delà duquel la commande échoue")
+    parser.add_argument('--conserver', nargs='*', default=None, metavar='COLONNE',
+                        help="Colonnes supplémentaires à conserver dans les rapports ; seules les colonnes "
+                             "contrôlées et celles-ci sont lues (par défaut, toutes les colonnes)")
+    parser.add_argument('--mesures', default=None,
+                        help="Fichier où ajouter les mesures de performance de chaque étape, en lignes JSON")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    fichiers = lister_fichiers(args.chemins)
+    if not fichiers:
+        print(f"Aucun fichier ({', '.join('.' + ext for ext in extensions)}) à contrôler.", file=sys.stderr)
+        return 2
+    os.makedirs(args.sortie, exist_ok=True)
+    noms = noms_rapports(fichiers)
+
+    resumes = []
+    if args.processus <= 1 or len(fichiers) == 1:
+        for chemin in fichiers:
+            resumes.append(valider_fichier(chemin, args.sortie, args.format_rapport, args.mesures is not None, args.conserver,
+                                           args.processus, args.budget_memoire * 2**20, noms[chemin]))
+            print(f"[{len(resumes)}/{len(fichiers)}] {chemin}", file=sys.stderr)
+    else:
+        with ProcessPoolExecutor(max_workers=args.processus) as executor:
+            futures = {executor.submit(valider_fichier, chemin, args.sortie, args.format_rapport, args.mesures is not None, args.conserver,
+                                       1, args.budget_memoire * 2**20 // args.processus, noms[chemin]): chemin for chemin in fichiers}
+            for future in as_completed(futures):
+                try:
+                    resumes.append(future.result())
+                except BrokenProcessPool as e:
+                    # Processus interrompu (mémoire insuffisante...) : les fichiers concernés sont reportés en erreur
+                    resume = resume_fichier(futures[future], args.mesures is not None)
+                    resume['Erreur'] = f"Processus de contrôle interrompu : {e}"
+                    resumes.append(resume)
+                print(f"[{len(resumes)}/{len(fichiers)}] {futures[future]}", file=sys.stderr)
+
+    if args.mesures is not None:
+        with open(args.mesures, 'a', encoding='utf-8') as f:
+            for resume in resumes:
+                f.write(resume.pop('Mesures'))
+
+    # Récapitulatif consolidé, dans l'ordre des fichiers et du registre des anomalies
+    recapitulatif = pd.DataFrame(resumes).set_index('Fichier').loc[fichiers].reset_index()
+    colonnes_anomalies = [anomalie for anomalie in ANOMALIES if anomalie in recapitulatif.columns]
+    recapitulatif[colonnes_anomalies] = recapitulatif[colonnes_anomalies].fillna(0).astype(int)
+    recapitulatif = recapitulatif[['Fichier', 'Lignes', 'Lignes en anomalie'] + colonnes_anomalies + ['Rapport', 'Erreur']]
+    chemin_recapitulatif = os.path.join(args.sortie, 'recapitulatif.csv')
+    recapitulatif.to_csv(chemin_recapitulatif, index=False, encoding='utf-8')
+
+    total_anomalies = int(recapitulatif['Lignes en anomalie'].sum())
+    erreurs = recapitulatif[recapitulatif['Erreur'] != '']
+    print(f"{len(fichiers)} fichier(s) contrôlé(s), {total_anomalies} ligne(s) en anomalie, "
+          f"{len(erreurs)} erreur(s). Récapitulatif : {chemin_recapitulatif}")
+    for _, erreur in erreurs.iterrows():
+        print(f"Erreur sur {erreur['Fichier']} : {erreur['Erreur']}", file=sys.stderr)
+
+    if len(erreurs):
+        return 2
+    if args.seuil is not None and total_anomalies > args.seuil:
+        print(f"Seuil dépassé : {total_anomalies} ligne(s) en anomalie pour un seuil de {args.seuil}.", file=sys.stderr)
+        return 1
+    return 0
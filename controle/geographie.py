@@ -0,0 +1,122 @@
+"""
+Plausibilité des coordonnées GPS par commune.
+
+Chaque point est comparé au centre de sa commune : centre d'un référentiel
+local (fichier CSV, voir lire_referentiel_communes) ou, à défaut, médianes
+des coordonnées des compteurs de la commune dans le fichier contrôlé. Les
+points sont indexés par commune (empreinte du nom) et toutes les distances
+sont calculées en une seule opération vectorisée.
+"""
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+# Référentiel des communes (chemin d'un fichier CSV), facultatif
+REFERENTIEL_COMMUNES = os.environ.get('CONTROLE_REFERENTIEL_COMMUNES') or None
+
+RAYON_TERRE_KM = 6371.0
+
+# Distance au centre de la commune tolérée au minimum, et par défaut pour le référentiel
+RAYON_MIN_KM = 10.0
+
+# Distance tolérée en multiple de la distance médiane des compteurs au centre de la commune
+FACTEUR_DISPERSION = 5.0
+
+# Nombre minimal de points pour estimer le centre d'une commune à partir du fichier
+MIN_POINTS_COMMUNE = 5
+
+def cles_communes(communes):
+    """
+    Empreintes 64 bits des noms de commune (sans espaces superflus, en
+    majuscules), calculées une fois par valeur distincte. Renvoie les
+    empreintes et le masque des communes renseignées.
+    """
+    codes, valeurs = pd.factorize(communes)
+    noms = pd.Series(valeurs, dtype=object).astype(str).str.strip().str.upper()
+    empreintes = pd.util.hash_pandas_object(noms, index=False, categorize=False).to_numpy().view(np.int64)
+    renseignee = np.append((noms != '').to_numpy() & (noms != 'NAN').to_numpy(), False)
+    return np.append(empreintes, 0)[codes], renseignee[codes]
+
+def distance_km(latitude1, longitude1, latitude2, longitude2):
+    """
+    Distance orthodromique en kilomètres (formule de haversine), élément par
+    élément.
+    """
+    latitude1, longitude1, latitude2, longitude2 = map(np.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = (np.sin((latitude2 - latitude1) / 2) ** 2
+         + np.cos(latitude1) * np.cos(latitude2) * np.sin((longitude2 - longitude1) / 2) ** 2)
+    return 2 * RAYON_TERRE_KM * np.arcsin(np.sqrt(a))
+
+def centres_communes(commune, latitude, longitude):
+    """
+    Centre et rayon toléré de chaque commune estimés à partir des points du
+    fichier : médianes des latitudes et des longitudes, et rayon égal à
+    FACTEUR_DISPERSION fois la distance médiane des points à ce centre (au
+    moins RAYON_MIN_KM). Les communes de moins de MIN_POINTS_COMMUNE points
+    ne sont pas retenues.
+    Renvoie un DataFrame indexé par empreinte de commune ('Latitude',
+    'Longitude', 'Rayon').
+    """
+    points = pd.DataFrame({'commune': commune, 'Latitude': latitude, 'Longitude': longitude}).dropna()
+    groupes = points.groupby('commune')
+    centres = groupes[['Latitude', 'Longitude']].median()
+    centres = centres[groupes.size() >= MIN_POINTS_COMMUNE]
+    points = points[points['commune'].isin(centres.index)]
+    centre_points = centres.loc[points['commune']].to_numpy()
+    distances = pd.Series(
+        distance_km(points['Latitude'].to_numpy(), points['Longitude'].to_numpy(), centre_points[:, 0], centre_points[:, 1]),
+        index=points['commune'].to_numpy()
+    )
+    centres['Rayon'] = np.maximum(distances.groupby(level=0).median() * FACTEUR_DISPERSION, RAYON_MIN_KM)
+    return centres
+
+@lru_cache(maxsize=4)
+def lire_referentiel_communes(chemin):
+    """
+    Lit un référentiel des communes : fichier CSV (délimiteur détecté) aux
+    colonnes 'Commune', 'Latitude', 'Longitude' et, facultativement,
+    'Rayon' (distance tolérée en km, RAYON_MIN_KM par défaut).
+    Renvoie un DataFrame indexé par empreinte de commune (voir
+    centres_communes).
+    """
+    referentiel = pd.read_csv(chemin, sep=None, engine='python', dtype={'Commune': str}, encoding='utf-8-sig')
+    if 'Rayon' not in referentiel.columns:
+        referentiel['Rayon'] = RAYON_MIN_KM
+    cles, renseignee = cles_communes(referentiel['Commune'])
+    centres = pd.DataFrame({
+        col: pd.to_numeric(referentiel[col], errors='coerce').to_numpy() for col in ('Latitude', 'Longitude', 'Rayon')
+    }, index=cles)
+    centres['Rayon'] = centres['Rayon'].fillna(RAYON_MIN_KM)
+    centres = centres[renseignee & centres['Latitude'].notna().to_numpy() & centres['Longitude'].notna().to_numpy()]
+    return centres[~centres.index.duplicated()]
+
+def referentiel_communes():
+    """
+    Référentiel des communes configuré par CONTROLE_REFERENTIEL_COMMUNES, ou
+    None.
+    """
+    return None if REFERENTIEL_COMMUNES is None else lire_referentiel_communes(REFERENTIEL_COMMUNES)
+
+def hors_commune(commune, latitude, longitude, referentiel=None):
+    """
+    Points plus éloignés du centre de leur commune que le rayon toléré. Les
+    centres du referentiel (voir lire_referentiel_communes) priment sur ceux
+    estimés à partir du fichier ; les points sans coordonnées (NaN), sans
+    commune (empreinte manquante) ou dont la commune n'a pas de centre ne
+    sont pas signalés.
+    """
+    commune = pd.array(commune, dtype='Int64')
+    centres = centres_communes(commune, latitude, longitude)
+    if referentiel is not None:
+        centres = referentiel.combine_first(centres)
+    positions = centres.index.get_indexer(commune.to_numpy(dtype=np.int64, na_value=0))
+    positions[np.asarray(pd.isna(commune))] = -1
+    connue = positions >= 0
+    resultat = np.zeros(len(positions), dtype=bool)
+    centre = centres[['Latitude', 'Longitude', 'Rayon']].to_numpy()[positions[connue]]
+    distances = distance_km(np.asarray(latitude)[connue], np.asarray(longitude)[connue], centre[:, 0], centre[:, 1])
+    # Les distances NaN (coordonnées manquantes) ne dépassent pas le rayon
+    resultat[connue] = distances > centre[:, 2]
+    return resultat
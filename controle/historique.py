@@ -0,0 +1,194 @@
+"""
+Contrôle incrémental par rapport au contrôle précédent.
+
+Un référentiel (fichier Parquet) conserve, pour chaque ligne du dernier
+fichier contrôlé, sa clé (Numéro de compteur / Numéro de tête), l'empreinte
+de ses colonnes contrôlées et son code d'anomalie. Lors du contrôle suivant,
+seules les lignes nouvelles ou modifiées sont contrôlées ; les résultats des
+lignes inchangées sont repris, et l'évolution des anomalies (nouvelles,
+persistantes, résolues) est calculée par type d'anomalie.
+"""
+import os
+import re
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .cache import ecriture_atomique
+from .mesures import mesurer
+from .regles import (
+    ANOMALIE_BITS, REGLES, REGLES_TRANSVERSES, VERSION_REGLES, cles_transverses, evaluer_regles,
+    joindre_colonnes, normaliser_donnees, required_columns, resultats_controle, valeurs_transverses, verifier_colonnes
+)
+
+# Répertoire des référentiels
+HISTORIQUE_REPERTOIRE = os.environ.get('CONTROLE_HISTORIQUE_REPERTOIRE', 'historique')
+
+# Colonnes identifiant un compteur d'un contrôle à l'autre
+colonnes_cle = ['Numéro de compteur', 'Numéro de tête']
+
+def cles_lignes(df):
+    """
+    Clé de chaque ligne : empreinte 64 bits du couple (Numéro de compteur,
+    Numéro de tête). Les lignes partageant le même couple sont distinguées
+    par leur rang d'apparition.
+    """
+    cles = pd.util.hash_pandas_object(
+        pd.DataFrame({col: df[col].astype(object).fillna('') for col in colonnes_cle}), index=False, categorize=False
+    ).to_numpy()
+    doublons = pd.Series(cles).duplicated(keep=False).to_numpy()
+    if doublons.any():
+        rang = pd.Series(cles[doublons]).groupby(cles[doublons]).cumcount().to_numpy()
+        cles[doublons] = pd.util.hash_pandas_object(pd.DataFrame({'cle': cles[doublons], 'rang': rang}), index=False).to_numpy()
+    return cles.view(np.int64)
+
+def empreintes_lignes(df):
+    """
+    Empreinte 64 bits des colonnes contrôlées de chaque ligne.
+    """
+    return pd.util.hash_pandas_object(df[required_columns], index=False, categorize=False).to_numpy().view(np.int64)
+
+def nom_referentiel(nom):
+    """
+    Nom de fichier sûr pour un référentiel.
+    """
+    return re.sub(r'[^\w.-]', '_', nom).strip('._') or 'referentiel'
+
+class Historique:
+    """
+    Référentiel du dernier contrôle, stocké dans un fichier Parquet. Le
+    fichier est remplacé de façon atomique à chaque enregistrement.
+    """
+    def __init__(self, chemin):
+        self.chemin = chemin
+
+    @classmethod
+    def depuis_nom(cls, nom, repertoire=HISTORIQUE_REPERTOIRE):
+        return cls(os.path.join(repertoire, nom_referentiel(nom) + '.parquet'))
+
+    def charger(self):
+        """
+        Renvoie (lignes, informations) : DataFrame 'cle', 'empreinte', 'code'
+        du dernier contrôle et ses métadonnées (date, fichier). Renvoie
+        (None, None) si le référentiel n'existe pas ou a été produit par une
+        autre version des règles.
+        """
+        if not os.path.exists(self.chemin):
+            return None, None
+        table = pq.read_table(self.chemin)
+        informations = {cle.decode(): valeur.decode() for cle, valeur in (table.schema.metadata or {}).items()
+                        if not cle.startswith(b'pandas')}
+        if informations.get('version_regles') != VERSION_REGLES:
+            return None, None
+        return table.to_pandas(), informations
+
+    def enregistrer(self, cles, empreintes, codes, fichier=''):
+        """
+        Remplace le référentiel par les lignes du contrôle courant.
+        """
+        table = pa.table({'cle': cles, 'empreinte': empreintes, 'code': codes})
+        table = table.replace_schema_metadata({
+            'version_regles': VERSION_REGLES,
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'fichier': fichier,
+        })
+        repertoire = os.path.dirname(self.chemin)
+        if repertoire:
+            os.makedirs(repertoire, exist_ok=True)
+        # Deux contrôles simultanés (threads d'un même processus ou processus distincts) ne s'écrasent pas
+        with ecriture_atomique(self.chemin) as f:
+            pq.write_table(table, f)
+
+@dataclass
+class BilanHistorique:
+    """
+    Bilan d'un contrôle incrémental : référentiel de comparaison (None au
+    premier contrôle), nombre de lignes reprises et contrôlées, et évolution
+    des anomalies par type.
+    """
+    reference: dict
+    lignes_reprises: int
+    lignes_controlees: int
+    evolution: pd.DataFrame
+
+def comparer_anomalies(codes_avant, codes_apres, presentes_avant):
+    """
+    Évolution des anomalies par type entre deux contrôles, pour les lignes
+    du fichier courant : 'Nouvelles' (absentes du contrôle précédent ou
+    ligne nouvelle), 'Persistantes' et 'Résolues' (ligne toujours présente
+    mais plus en anomalie). Seuls les types concernés sont renvoyés.
+    """
+    lignes = []
+    for libelle, bit in ANOMALIE_BITS.items():
+        avant = ((codes_avant & bit) != 0) & presentes_avant
+        apres = (codes_apres & bit) != 0
+        nouvelles, persistantes, resolues = int((apres & ~avant).sum()), int((apres & avant).sum()), int((avant & ~apres).sum())
+        if nouvelles or persistantes or resolues:
+            lignes.append((libelle, nouvelles, persistantes, resolues))
+    return pd.DataFrame(lignes, columns=['Anomalie', 'Nouvelles', 'Persistantes', 'Résolues']).set_index('Anomalie')
+
+def check_data_incremental(df, historique, fichier='', mesures=None):
+    """
+    Contrôle df en ne vérifiant que les lignes nouvelles ou modifiées depuis
+    le contrôle enregistré dans historique ; les codes d'anomalie des lignes
+    inchangées sont repris. Les règles transverses (voir Regle), qui dépendent
+    des autres lignes, sont réévaluées sur tout le fichier. Le référentiel
+    est ensuite remplacé par le contrôle courant.
+    Renvoie les résultats de check_data et un BilanHistorique.
+    Lève ColonnesManquantes si une colonne requise est absente.
+    """
+    verifier_colonnes(df)
+
+    with mesurer(mesures, 'historique:empreintes', len(df)):
+        cles = cles_lignes(df)
+        empreintes = empreintes_lignes(df)
+    with mesurer(mesures, 'historique:chargement'):
+        precedent, reference = historique.charger()
+
+    # Reprise des codes des lignes dont l'empreinte n'a pas changé
+    codes_avant = np.zeros(len(df), dtype=np.int64)
+    presentes_avant = np.zeros(len(df), dtype=bool)
+    inchangees = np.zeros(len(df), dtype=bool)
+    if precedent is not None:
+        positions = pd.Index(precedent['cle']).get_indexer(cles)
+        presentes_avant = positions >= 0
+        codes_avant[presentes_avant] = precedent['code'].to_numpy()[positions[presentes_avant]]
+        inchangees[presentes_avant] = precedent['empreinte'].to_numpy()[positions[presentes_avant]] == empreintes[presentes_avant]
+    codes = np.where(inchangees, codes_avant, 0)
+
+    # Règles transverses sur toutes les lignes, à partir des seules colonnes comparées
+    with mesurer(mesures, 'cles_transverses', len(df)):
+        transverses = valeurs_transverses(cles_transverses(df, normaliser=True))
+    codes = evaluer_regles(df, REGLES_TRANSVERSES, codes, mesures, transverses)
+
+    # Seules les lignes à contrôler et les lignes en anomalie sont normalisées
+    a_controler = ~inchangees
+    utiles = np.flatnonzero(a_controler | (codes != 0))
+    with mesurer(mesures, 'normalisation', len(utiles)):
+        travail = normaliser_donnees(df, utiles)
+    codes_utiles = codes[utiles]
+    controlees = a_controler[utiles]
+    regles_par_ligne = [regle for regle in REGLES if not regle.transverse]
+    codes_utiles[controlees] = evaluer_regles(travail[controlees], regles_par_ligne, codes_utiles[controlees], mesures)
+    codes[utiles] = codes_utiles
+
+    # Seules les lignes en anomalie sont reprises avec toutes leurs colonnes
+    en_anomalie = np.flatnonzero(codes_utiles)
+    with mesurer(mesures, 'jointure', len(en_anomalie)):
+        anomalies_df = joindre_colonnes(df.take(utiles[en_anomalie]), travail.take(en_anomalie))
+    resultats = resultats_controle(anomalies_df, codes_utiles[en_anomalie], mesures)
+
+    with mesurer(mesures, 'historique:enregistrement', len(df)):
+        historique.enregistrer(cles, empreintes, codes, fichier)
+
+    bilan = BilanHistorique(
+        reference=reference,
+        lignes_reprises=int(inchangees.sum()),
+        lignes_controlees=int(a_controler.sum()),
+        evolution=comparer_anomalies(codes_avant, codes, presentes_avant),
+    )
+    return resultats + (bilan,)
@@ -0,0 +1,245 @@
+"""
+Lecture des fichiers de radiorelève.
+"""
+import codecs
+import csv
+import importlib.util
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.feather as feather
+import pyarrow.ipc
+import pyarrow.parquet as pq
+
+from .mesures import mesurer
+from .regles import TEXTE_ARROW, colonnes_texte, required_columns
+
+# Version de la lecture des fichiers, à incrémenter à chaque modification des tableaux lus
+# (colonnes, types, conversions) pour invalider les lectures et les contrôles mis en cache
+VERSION_LECTURE = '1'
+
+# Extensions de fichier acceptées
+extensions = ['csv', 'xlsx', 'parquet', 'arrow', 'feather']
+
+# Formats en colonnes (Parquet et Arrow IPC), lus sans conversion texte
+formats_colonnes = ['parquet', 'arrow', 'feather']
+
+# Types imposés à la lecture pour les identifiants à ne pas convertir en nombres
+dtype_mapping = {
+    'Numéro de branchement': str,
+    'Abonnement': str
+}
+
+# Types imposés à la lecture des fichiers CSV et Excel
+dtypes_lecture = {**dict.fromkeys(colonnes_texte, str), **dtype_mapping}
+
+# Taille de l'échantillon lu pour détecter l'encodage et le délimiteur
+TAILLE_ECHANTILLON = 64 * 1024
+
+# Délimiteurs recherchés dans les fichiers CSV
+delimiteurs_csv = ';,\t|'
+
+# Lecteur Excel en Rust (python-calamine), utilisé à la place d'openpyxl s'il est installé
+moteur_excel = 'calamine' if importlib.util.find_spec('python_calamine') else 'openpyxl'
+
+def detecter_encodage(echantillon):
+    """
+    Détecte l'encodage d'un échantillon d'octets : UTF-8 (avec ou sans BOM),
+    sinon Windows-1252, sinon Latin-1 qui accepte tous les octets.
+    """
+    if echantillon.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        echantillon.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError as e:
+        # Un caractère multi-octets peut être coupé en fin d'échantillon
+        if e.start >= len(echantillon) - 3 and e.reason == 'unexpected end of data':
+            return 'utf-8'
+    try:
+        echantillon.decode('cp1252')
+        return 'cp1252'
+    except UnicodeDecodeError:
+        return 'latin-1'
+
+def detecter_format_csv(file):
+    """
+    Détecte l'encodage et le délimiteur d'un fichier CSV à partir de ses
+    premiers octets et lit les noms de colonnes de l'en-tête.
+    Renvoie (encodage, délimiteur, colonnes) ; le fichier est rembobiné.
+    """
+    echantillon = file.read(TAILLE_ECHANTILLON)
+    file.seek(0)
+    encodage = detecter_encodage(echantillon)
+    lignes = echantillon.decode(encodage, errors='ignore').splitlines()
+    # La dernière ligne d'un échantillon tronqué peut être incomplète
+    if len(echantillon) == TAILLE_ECHANTILLON and len(lignes) > 1:
+        lignes = lignes[:-1]
+    lignes = lignes[:50]
+    try:
+        delimiter = csv.Sniffer().sniff('\n'.join(lignes), delimiters=delimiteurs_csv).delimiter
+    except csv.Error:
+        delimiter = ','
+    colonnes = next(csv.reader(lignes[:1], delimiter=delimiter), [])
+    return encodage, delimiter, colonnes
+
+def get_csv_delimiter(file):
+    """
+    Détecte automatiquement le délimiteur d'un fichier CSV.
+    """
+    return detecter_format_csv(file)[1]
+
+def extension_fichier(nom):
+    """
+    Renvoie l'extension d'un nom de fichier, en minuscules et sans le point.
+    """
+    return os.path.splitext(nom)[1].lstrip('.').lower()
+
+# Colonnes toujours chargées : colonnes contrôlées et identifiants des lignes
+colonnes_chargees = required_columns + [col for col in dtype_mapping if col not in required_columns]
+
+def colonnes_lues(colonnes_fichier, colonnes_conservees=None):
+    """
+    Colonnes du fichier à charger, dans l'ordre du fichier : colonnes
+    contrôlées, identifiants et colonnes_conservees (colonnes supplémentaires
+    à conserver dans le rapport). Renvoie None (toutes les colonnes) si
+    colonnes_conservees est None.
+    """
+    if colonnes_conservees is None:
+        return None
+    utiles = set(colonnes_chargees).union(colonnes_conservees)
+    return [col for col in colonnes_fichier if col in utiles]
+
+def colonnes_fichier(file, file_extension):
+    """
+    Noms des colonnes d'un fichier, lus sans charger les données.
+    """
+    if file_extension == 'csv':
+        return detecter_format_csv(file)[2]
+    if file_extension == 'parquet':
+        noms = pq.ParquetFile(file).schema_arrow.names
+    elif file_extension in formats_colonnes:
+        noms = pa.ipc.open_file(file).schema.names
+    else:
+        noms = pd.read_excel(file, nrows=0, engine=moteur_excel).columns.tolist()
+    file.seek(0)
+    return noms
+
+def _chaines_arrow(type_arrow):
+    """
+    Correspondance des types Arrow vers pandas : les chaînes restent
+    adossées à Arrow, les autres types suivent la conversion par défaut.
+    """
+    if type_arrow in (pa.string(), pa.large_string()):
+        return TEXTE_ARROW
+    return None
+
+def lire_table_arrow(file, file_extension, colonnes_conservees=()):
+    """
+    Lit un fichier Parquet ou Arrow IPC (chemin ou objet fichier) en ne
+    chargeant que les colonnes retenues par colonnes_lues (par défaut, les
+    colonnes contrôlées et les identifiants). Les colonnes texte sont des
+    chaînes adossées à Arrow.
+    """
+    if file_extension == 'parquet':
+        fichier_parquet = pq.ParquetFile(file)
+        table = fichier_parquet.read(columns=colonnes_lues(fichier_parquet.schema_arrow.names, colonnes_conservees))
+    else:
+        # Seules les colonnes retenues sont lues du fichier Arrow IPC, à partir de son schéma
+        noms = pa.ipc.open_file(file).schema.names
+        if hasattr(file, 'seek'):
+            file.seek(0)
+        table = feather.read_table(file, columns=colonnes_lues(noms, colonnes_conservees))
+    return table.to_pandas(types_mapper=_chaines_arrow)
+
+# Valeurs lues comme manquantes, comme pour pd.read_csv
+valeurs_manquantes = [
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'
+]
+
+def lire_csv_arrow(file, encodage, delimiter, usecols=None):
+    """
+    Lecture CSV multithread avec pyarrow, limitée à usecols (toutes les
+    colonnes si None). Les colonnes de dtypes_lecture sont lues en chaînes
+    Arrow ; les types des autres colonnes sont déduits comme avec
+    pd.read_csv (les dates reconnues par pyarrow restent du texte et les
+    colonnes texte sont de type objet, avec NaN pour les valeurs manquantes).
+    """
+    table = pacsv.read_csv(
+        file,
+        read_options=pacsv.ReadOptions(encoding=encodage),
+        parse_options=pacsv.ParseOptions(delimiter=delimiter),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=usecols or [],
+            column_types=dict.fromkeys(dtypes_lecture, pa.string()),
+            null_values=valeurs_manquantes,
+            strings_can_be_null=True,
+        ),
+    )
+    for i, champ in enumerate(table.schema):
+        if pa.types.is_temporal(champ.type):
+            table = table.set_column(i, champ.name, table.column(i).cast(pa.string()))
+    df = table.to_pandas(types_mapper=_chaines_arrow)
+    for col in df.columns:
+        if col not in dtypes_lecture and df[col].dtype == TEXTE_ARROW:
+            df[col] = df[col].astype(object).where(df[col].notna(), np.nan)
+    return df
+
+def lire_csv(file, colonnes_conservees=None, mesures=None):
+    """
+    Lit un fichier CSV (objet fichier binaire) en ne chargeant que les
+    colonnes retenues par colonnes_lues. Le moteur multithread de pyarrow
+    est utilisé ; le moteur C de pandas, plus tolérant (lignes incomplètes),
+    prend le relais en cas d'échec.
+    Renvoie le DataFrame et le délimiteur détecté.
+    """
+    with mesurer(mesures, 'detection_format'):
+        encodage, delimiter, colonnes = detecter_format_csv(file)
+    usecols = colonnes_lues(colonnes, colonnes_conservees)
+    with mesurer(mesures, 'lecture_csv') as mesure:
+        df = None
+        # Les noms de colonnes en double sont renommés par pandas uniquement
+        if len(set(colonnes)) == len(colonnes):
+            try:
+                df = lire_csv_arrow(file, encodage, delimiter, usecols)
+            except (pa.ArrowException, ValueError):
+                file.seek(0)
+        if df is None:
+            mesure['etape'] = 'lecture_csv_pandas'
+            df = pd.read_csv(file, sep=delimiter, encoding=encodage, dtype=dtypes_lecture, usecols=usecols)
+        mesure['lignes'] = len(df)
+    return df, delimiter
+
+def lire_fichier(file, file_extension, mesures=None, colonnes_conservees=None):
+    """
+    Lit un fichier CSV, Excel, Parquet ou Arrow IPC (chemin ou objet fichier).
+    Renvoie le DataFrame et le délimiteur détecté (None hors CSV).
+    Seules les colonnes contrôlées, les identifiants et colonnes_conservees
+    sont chargés. Si colonnes_conservees est None, toutes les colonnes des
+    fichiers CSV et Excel sont chargées, et seules les colonnes utiles des
+    fichiers Parquet et Arrow IPC.
+    Lève ValueError si le format n'est pas pris en charge.
+    """
+    if isinstance(file, (str, os.PathLike)) and file_extension in ('csv', 'xlsx'):
+        with open(file, 'rb') as f:
+            return lire_fichier(f, file_extension, mesures, colonnes_conservees)
+    if file_extension == 'csv':
+        return lire_csv(file, colonnes_conservees, mesures)
+    if file_extension == 'xlsx':
+        with mesurer(mesures, 'lecture_xlsx') as mesure:
+            usecols = None
+            if colonnes_conservees is not None:
+                usecols = colonnes_lues(colonnes_fichier(file, file_extension), colonnes_conservees)
+            df = pd.read_excel(file, dtype=dtypes_lecture, usecols=usecols, engine=moteur_excel)
+            mesure['lignes'] = len(df)
+        return df, None
+    if file_extension in formats_colonnes:
+        with mesurer(mesures, f'lecture_{file_extension}') as mesure:
+            df = lire_table_arrow(file, file_extension, () if colonnes_conservees is None else colonnes_conservees)
+            mesure['lignes'] = len(df)
+        return df, None
+    raise ValueError("Format de fichier non pris en charge. Veuillez utiliser un fichier .csv, .xlsx, .parquet ou .arrow.")
@@ -0,0 +1,90 @@
+"""
+Instrumentation des contrôles : durée, nombre de lignes et variation de la
+mémoire du processus pour chaque étape (lecture, normalisation, chaque
+règle, exports).
+
+Les mesures sont collectées dans un objet Mesures transmis aux fonctions
+instrumentées (paramètre mesures, facultatif) et peuvent être exportées en
+JSON ou en lignes de journal. Chaque mesure est également journalisée au
+niveau DEBUG sur le journal 'controle.mesures'.
+"""
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+
+journal = logging.getLogger(__name__)
+
+_TAILLE_PAGE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+def memoire_processus():
+    """
+    Mémoire résidente du processus en octets, ou None si elle n'est pas
+    disponible (lecture de /proc, Linux uniquement).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _TAILLE_PAGE
+    except (OSError, ValueError, IndexError):
+        return None
+
+class Mesures:
+    """
+    Collecte des mesures des étapes d'un traitement, dans l'ordre où elles
+    se terminent.
+    """
+    def __init__(self):
+        self.etapes = []
+
+    @contextmanager
+    def etape(self, nom, nb_lignes=None):
+        """
+        Mesure le bloc exécuté dans le contexte. Le dictionnaire de la mesure
+        est renvoyé au bloc, qui peut y ajouter des informations (par exemple
+        le nombre de lignes en anomalie d'une règle).
+        """
+        mesure = {'etape': nom, 'lignes': nb_lignes}
+        memoire_depart = memoire_processus()
+        depart = time.perf_counter()
+        try:
+            yield mesure
+        finally:
+            mesure['duree_s'] = round(time.perf_counter() - depart, 6)
+            memoire_fin = memoire_processus()
+            mesure['memoire_delta_mo'] = (
+                None if memoire_depart is None or memoire_fin is None
+                else round((memoire_fin - memoire_depart) / 2**20, 3)
+            )
+            self.etapes.append(mesure)
+            journal.debug(json.dumps(mesure, ensure_ascii=False))
+
+    def to_dataframe(self):
+        """
+        Mesures sous forme de tableau, une ligne par étape.
+        """
+        return pd.DataFrame(self.etapes, columns=['etape', 'lignes', 'duree_s', 'memoire_delta_mo', 'lignes_en_anomalie'])
+
+    def to_json(self):
+        """
+        Mesures au format JSON (liste d'objets).
+        """
+        return json.dumps(self.etapes, ensure_ascii=False)
+
+    def lignes_journal(self, **contexte):
+        """
+        Mesures en lignes de journal JSON, une par étape, complétées des
+        champs de contexte fournis (nom du fichier, date...).
+        """
+        return ''.join(json.dumps({**contexte, **mesure}, ensure_ascii=False) + '\n' for mesure in self.etapes)
+
+def mesurer(mesures, nom, nb_lignes=None):
+    """
+    Contexte de mesure de l'étape nom si mesures est fourni, contexte sans
+    effet sinon.
+    """
+    if mesures is None:
+        return nullcontext({})
+    return mesures.etape(nom, nb_lignes)
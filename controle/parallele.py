@@ -0,0 +1,164 @@
+"""
+Exécution des contrôles sur plusieurs processus.
+
+Le DataFrame est découpé en partitions de lignes contiguës ; chaque
+processus normalise les colonnes contrôlées de sa partition, évalue les
+règles et ne renvoie que le masque de bits des anomalies de ses lignes. Les
+valeurs des règles transverses, qui dépendent de tout le fichier, sont
+calculées une seule fois par le processus principal, qui normalise ensuite
+les seules lignes en anomalie pour construire des résultats identiques à
+ceux de check_data. Les partitions sont assez nombreuses pour que la
+mémoire de travail des processus simultanés reste dans le budget de mémoire
+(voir lignes_par_bloc).
+
+Lorsque les processus sont créés par fork (Linux), les partitions ne sont
+pas copiées : les processus les lisent dans la mémoire héritée du processus
+principal. Sinon, elles leur sont transmises par sérialisation. C'est le cas
+du groupe de processus partagé par les contrôles simultanés d'une
+application (voir executeur_partage), fork n'étant pas sûr depuis un
+processus à plusieurs fils d'exécution.
+"""
+import multiprocessing
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+
+import numpy as np
+
+from .mesures import Mesures, mesurer
+from .regles import (
+    BUDGET_MEMOIRE, categories_blocs, check_data, colonnes_categorielles, evaluer_regles, joindre_colonnes,
+    lignes_par_bloc, normaliser_donnees, required_columns, resultats_controle, transverses_blocs, verifier_colonnes
+)
+
+# Nombre de processus par défaut
+PROCESSUS = int(os.environ.get('CONTROLE_PROCESSUS', 0)) or os.cpu_count() or 1
+
+# En deçà de ce nombre de lignes, les contrôles sont exécutés en série
+LIGNES_MIN_PARALLELE = 200_000
+
+# Colonnes converties en nombres par normaliser_donnees
+colonnes_numeriques = ['Latitude', 'Longitude', 'Diametre']
+
+# DataFrames partagés avec les processus créés par fork, par jeton
+_partages = {}
+
+# Groupe de processus partagé par les contrôles simultanés (voir executeur_partage)
+_executeur = None
+_verrou_executeur = threading.Lock()
+
+def executeur_partage(processus=PROCESSUS):
+    """
+    Groupe de processus partagé par tous les contrôles du processus courant,
+    créé au premier appel avec processus processus, démarrés par forkserver
+    (ou spawn là où il n'existe pas) plutôt que par fork.
+    """
+    global _executeur
+    with _verrou_executeur:
+        if _executeur is None:
+            methode = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _executeur = ProcessPoolExecutor(max_workers=processus, mp_context=multiprocessing.get_context(methode))
+        return _executeur
+
+def _abandonner_executeur(executeur):
+    """
+    Oublie le groupe de processus partagé executeur, interrompu par l'arrêt
+    brutal d'un de ses processus : le suivant sera recréé.
+    """
+    global _executeur
+    with _verrou_executeur:
+        if _executeur is executeur:
+            _executeur = None
+
+def _controler_partition(partition, debut, fin, transverses, mesurer_etapes):
+    """
+    Contrôle les lignes debut à fin d'une partition (DataFrame, ou jeton
+    d'un DataFrame partagé). Renvoie le masque de bits des anomalies, les
+    types des colonnes numériques normalisées et les mesures des étapes.
+    """
+    if isinstance(partition, str):
+        partition = _partages[partition]
+    partition = partition.iloc[debut:fin]
+    mesures = Mesures() if mesurer_etapes else None
+    with mesurer(mesures, 'normalisation', len(partition)):
+        travail = normaliser_donnees(partition)
+    codes = evaluer_regles(travail, mesures=mesures, transverses=transverses)
+    types = {col: travail[col].dtype for col in colonnes_numeriques}
+    return codes, types, [] if mesures is None else mesures.etapes
+
+def harmoniser_types(travail, categories, types_partitions):
+    """
+    Donne aux colonnes normalisées des seules lignes en anomalie les types
+    qu'elles auraient eus en normalisant tout le DataFrame : categories de
+    l'ensemble des lignes (voir categories_blocs) et type numérique commun
+    aux partitions.
+    """
+    for col in colonnes_categorielles:
+        travail[col] = travail[col].cat.set_categories(categories[col])
+    for col in colonnes_numeriques:
+        travail[col] = travail[col].astype(np.result_type(*(types[col] for types in types_partitions)))
+    return travail
+
+def check_data_parallele(df, processus=PROCESSUS, mesures=None, budget=BUDGET_MEMOIRE, partage=False):
+    """
+    Équivalent de check_data réparti sur processus processus. Les fichiers
+    de moins de LIGNES_MIN_PARALLELE lignes, ou processus <= 1, sont
+    contrôlés en série par check_data, avec le même budget de mémoire.
+    Si partage est vrai, les partitions sont confiées au groupe de processus
+    partagé (voir executeur_partage) plutôt qu'à des processus créés pour
+    ce seul contrôle.
+    Lève ColonnesManquantes si une colonne requise est absente.
+    """
+    verifier_colonnes(df)
+    if processus <= 1 or len(df) < LIGNES_MIN_PARALLELE:
+        return check_data(df, mesures=mesures, budget=budget)
+
+    # Les processus simultanés se partagent le budget de mémoire
+    taille_partition = min(lignes_par_bloc(len(df), budget, processus), -(-len(df) // processus))
+    colonnes = df[required_columns]
+    bornes = np.append(np.arange(0, len(df), taille_partition), len(df))
+
+    def partitions():
+        return (df.iloc[debut:fin] for debut, fin in zip(bornes[:-1], bornes[1:]))
+
+    with mesurer(mesures, 'cles_transverses', len(df)):
+        transverses = transverses_blocs(partitions())
+    executeur = executeur_partage(processus) if partage else ProcessPoolExecutor(max_workers=processus)
+    fork = not partage and multiprocessing.get_start_method() == 'fork'
+    jeton = uuid.uuid4().hex
+    if fork:
+        _partages[jeton] = colonnes
+    try:
+        with mesurer(mesures, 'partitions', len(df)):
+            # Le groupe partagé reste ouvert pour les contrôles suivants
+            with nullcontext(executeur) if partage else executeur as executor:
+                futures = [
+                    executor.submit(
+                        _controler_partition,
+                        jeton if fork else colonnes.iloc[debut:fin],
+                        debut if fork else 0, fin if fork else fin - debut,
+                        transverses.iloc[debut:fin], mesures is not None
+                    )
+                    for debut, fin in zip(bornes[:-1], bornes[1:])
+                ]
+                resultats = [future.result() for future in futures]
+    except BrokenProcessPool:
+        if partage:
+            _abandonner_executeur(executeur)
+        raise
+    finally:
+        _partages.pop(jeton, None)
+
+    if mesures is not None:
+        for numero, (_, _, etapes) in enumerate(resultats):
+            mesures.etapes.extend({**etape, 'etape': f"partition_{numero}:{etape['etape']}"} for etape in etapes)
+
+    codes = np.concatenate([codes for codes, _, _ in resultats])
+    positions = np.flatnonzero(codes)
+    with mesurer(mesures, 'normalisation', len(positions)):
+        travail = harmoniser_types(normaliser_donnees(df, positions), categories_blocs(partitions()),
+                                   [types for _, types, _ in resultats])
+    return resultats_controle(joindre_colonnes(df.take(positions), travail), codes[positions], mesures)
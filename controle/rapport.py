@@ -0,0 +1,298 @@
+"""
+Génération des rapports d'anomalies : CSV, Parquet, classeur Excel et
+archive ZIP.
+
+Les rapports sont écrits au fil de l'eau, par blocs de lignes, sans copie
+préalable du tableau des anomalies ; fichier_export fournit un fichier
+temporaire où les écrire lorsqu'ils ne sont pas destinés au disque.
+"""
+import os
+import re
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from copy import copy
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import PatternFill, Font, Alignment
+from openpyxl.utils import get_column_letter
+from openpyxl.utils.dataframe import dataframe_to_rows
+
+from .mesures import mesurer
+from .regles import ANOMALIE_BITS, TEXTE_ARROW, anomaly_columns_map
+
+# Colonnes internes, retirées des tableaux affichés et exportés
+colonnes_internes = ['Anomalie Détaillée FP2E', 'Code anomalie']
+
+# Nombre de lignes écrites à la fois par les exports CSV et Parquet
+LIGNES_BLOC_EXPORT = 50_000
+
+# Taille au-delà de laquelle un export en cours d'écriture passe de la mémoire au disque
+EXPORT_MEMOIRE_MAX = int(os.environ.get('CONTROLE_EXPORT_MEMOIRE_MO', '16')) * 1024 * 1024
+
+def colonnes_affichees(anomalies_df):
+    """
+    Renvoie le tableau des anomalies tel qu'il est affiché et exporté.
+    """
+    return anomalies_df.drop(columns=colonnes_internes)
+
+def fichier_export():
+    """
+    Fichier temporaire binaire où écrire un rapport : conservé en mémoire
+    jusqu'à EXPORT_MEMOIRE_MAX octets, puis sur disque.
+    """
+    return tempfile.SpooledTemporaryFile(max_size=EXPORT_MEMOIRE_MAX)
+
+@contextmanager
+def ouvrir_sortie(fichier):
+    """
+    Objet fichier binaire où écrire : fichier lui-même, ou le fichier ouvert
+    s'il s'agit d'un chemin.
+    """
+    if isinstance(fichier, (str, os.PathLike)):
+        with open(fichier, 'wb') as sortie:
+            yield sortie
+    else:
+        yield fichier
+
+def blocs_affiches(anomalies_df, positions=None):
+    """
+    Colonnes affichées des lignes positions de anomalies_df (toutes par
+    défaut), par blocs de LIGNES_BLOC_EXPORT lignes. Un tableau vide donne un
+    bloc vide, pour que l'en-tête soit écrit.
+    """
+    colonnes = [i for i, col in enumerate(anomalies_df.columns) if col not in colonnes_internes]
+    nb_lignes = len(anomalies_df) if positions is None else len(positions)
+    for debut in range(0, max(nb_lignes, 1), LIGNES_BLOC_EXPORT):
+        lignes = (slice(debut, debut + LIGNES_BLOC_EXPORT) if positions is None
+                  else positions[debut:debut + LIGNES_BLOC_EXPORT])
+        yield anomalies_df.iloc[lignes, colonnes]
+
+def ecrire_csv(anomalies_df, sortie, delimiter=',', positions=None):
+    """
+    Écrit dans l'objet fichier binaire sortie les lignes positions du
+    tableau des anomalies (toutes par défaut), bloc par bloc.
+    """
+    for numero, bloc in enumerate(blocs_affiches(anomalies_df, positions)):
+        bloc.to_csv(sortie, header=numero == 0, index=False, sep=delimiter, encoding='utf-8')
+
+def ecrire_rapport_csv(anomalies_df, fichier, delimiter=',', mesures=None):
+    """
+    Écrit le tableau des anomalies au format CSV dans fichier (chemin ou
+    objet fichier binaire).
+    """
+    with mesurer(mesures, 'export_csv', len(anomalies_df)), ouvrir_sortie(fichier) as sortie:
+        ecrire_csv(anomalies_df, sortie, delimiter)
+
+def ecrire_rapport_parquet(anomalies_df, fichier, mesures=None):
+    """
+    Écrit le tableau des anomalies au format Parquet dans fichier (chemin ou
+    objet fichier), un groupe de lignes par bloc. Les colonnes de type
+    objet, qui peuvent mêler textes et nombres, sont écrites en texte.
+    """
+    def table_parquet(bloc, schema=None):
+        colonnes_objet = bloc.columns[bloc.dtypes == object]
+        return pa.Table.from_pandas(bloc.astype(dict.fromkeys(colonnes_objet, TEXTE_ARROW)), schema=schema,
+                                    preserve_index=False)
+
+    with mesurer(mesures, 'export_parquet', len(anomalies_df)):
+        # Le schéma du premier bloc (toujours présent, voir blocs_affiches) s'impose aux suivants
+        blocs = blocs_affiches(anomalies_df)
+        table = table_parquet(next(blocs))
+        with pq.ParquetWriter(fichier, table.schema) as writer:
+            writer.write_table(table)
+            for bloc in blocs:
+                writer.write_table(table_parquet(bloc, table.schema))
+
+def recapitulatif_anomalies(anomalies_df, anomaly_index):
+    """
+    Lignes du récapitulatif : nombre de lignes en anomalie, puis nombre de
+    cas de chaque type d'anomalie.
+    """
+    return [("Toutes les anomalies", len(anomalies_df))] + [
+        (anomaly_type, len(positions)) for anomaly_type, positions in anomaly_index.items()
+    ]
+
+# Styles du rapport Excel
+header_font = Font(bold=True)
+title_font = Font(bold=True, size=16)
+link_font = Font(underline="single", color="0563C1")
+red_fill = PatternFill(start_color='FFC7CE', end_color='FFC7CE', fill_type='solid')
+
+def longueurs_cellules(df):
+    """
+    Longueur du texte de chaque cellule du DataFrame, calculée colonne par
+    colonne. Sert à estimer la largeur des colonnes du rapport sans relire
+    les cellules de la feuille.
+    """
+    return pd.DataFrame({i: df.iloc[:, i].astype(str).str.len().to_numpy() for i in range(df.shape[1])})
+
+def noms_feuilles(anomaly_types):
+    """
+    Calcule un nom de feuille Excel valide et unique pour chaque type d'anomalie.
+    """
+    created_sheet_names = set(["Récapitulatif", "Toutes_Anomalies"])
+    sheet_names = []
+    for anomaly_type in anomaly_types:
+        # Logique pour raccourcir le nom de la feuille
+        if len(anomaly_type) > 28:
+            sheet_name_base = anomaly_type[:28]
+        else:
+            sheet_name_base = anomaly_type
+        
+        sheet_name = re.sub(r'[\\/?*\[\]:()\'"<>|]', '', sheet_name_base)
+        sheet_name = sheet_name.replace(' ', '_').replace('.', '').strip()
+        
+        original_sheet_name = sheet_name
+        counter = 1
+        while sheet_name in created_sheet_names:
+            sheet_name = f"{original_sheet_name[:28]}_{counter}"
+            counter += 1
+        created_sheet_names.add(sheet_name)
+        sheet_names.append(sheet_name)
+    return sheet_names
+
+def cellule(ws, value, font=None, fill=None, alignment=None, hyperlink=None):
+    """
+    Crée une cellule stylée pour une feuille en écriture seule.
+    """
+    cell = WriteOnlyCell(ws, value=value)
+    if font is not None:
+        cell.font = font
+    if fill is not None:
+        cell.fill = fill
+    if alignment is not None:
+        cell.alignment = alignment
+    if hyperlink is not None:
+        cell.hyperlink = hyperlink
+    return cell
+
+def blocs_excel(anomalies_df, positions=None):
+    """
+    Blocs affichés (voir blocs_affiches) prêts à être écrits par openpyxl,
+    qui n'accepte pas les valeurs manquantes pd.NA des colonnes nullables
+    (chaînes Arrow...) : elles sont remplacées par None, bloc par bloc.
+    """
+    for bloc in blocs_affiches(anomalies_df, positions):
+        for i in range(bloc.shape[1]):
+            colonne = bloc.iloc[:, i]
+            if isinstance(colonne.dtype, pd.api.extensions.ExtensionDtype) and colonne.hasnans:
+                bloc.isetitem(i, colonne.astype(object).where(colonne.notna(), None))
+        yield bloc
+
+def ecrire_feuille_anomalies(wb, title, anomalies_df, positions, codes, colonnes_surlignees):
+    """
+    Écrit la feuille des lignes positions du tableau des anomalies (toutes
+    si None), bloc par bloc : une première lecture des blocs fixe la
+    largeur des colonnes, puis chaque ligne est ajoutée avec ses cellules
+    surlignées. codes contient le code anomalie de ces lignes.
+    """
+    ws = wb.create_sheet(title=title)
+
+    # En écriture seule, les largeurs doivent être fixées avant d'écrire les lignes
+    longueurs_max = None
+    for bloc in blocs_excel(anomalies_df, positions):
+        longueurs = longueurs_cellules(bloc).max().to_numpy() if len(bloc) else np.zeros(bloc.shape[1], dtype=int)
+        longueurs_max = longueurs if longueurs_max is None else np.maximum(longueurs_max, longueurs)
+    for i, col in enumerate(bloc.columns):
+        max_length = max(len(str(col)), int(longueurs_max[i]))
+        ws.column_dimensions[get_column_letter(i + 1)].width = max_length + 2
+
+    # Le style des cellules surlignées est résolu une seule fois puis recopié
+    style_surligne = cellule(ws, None, fill=red_fill)._style
+
+    debut = 0
+    for numero, bloc in enumerate(blocs_excel(anomalies_df, positions)):
+        rows = dataframe_to_rows(bloc, index=False, header=numero == 0)
+        if numero == 0:
+            ws.append([cellule(ws, value, font=header_font) for value in next(rows)])
+        for row_data, code in zip(rows, codes[debut:debut + len(bloc)]):
+            for col_index in colonnes_surlignees(code):
+                cell = WriteOnlyCell(ws, value=row_data[col_index])
+                cell._style = copy(style_surligne)
+                row_data[col_index] = cell
+            ws.append(row_data)
+        debut += len(bloc)
+
+def ecrire_rapport_excel(anomalies_df, anomaly_index, fichier, mesures=None):
+    """
+    Génère le rapport Excel des anomalies dans fichier (chemin ou objet
+    fichier) : un récapitulatif avec liens, la feuille 'Toutes_Anomalies' et
+    une feuille par type d'anomalie, avec les cellules concernées en rouge.
+    Les feuilles par type d'anomalie et les nombres de cas sont tirés de
+    l'index inversé anomaly_index. Le classeur est écrit en mode écriture
+    seule, par blocs de lignes, sans copie du tableau des anomalies.
+    mesures, si fourni, reçoit la durée d'écriture de chaque feuille.
+    """
+    codes = anomalies_df['Code anomalie'].to_numpy()
+
+    # Correspondance nom de colonne -> position, et colonnes à surligner pour chaque code d'anomalie
+    col_indexes = {}
+    for i, col_name in enumerate(col for col in anomalies_df.columns if col not in colonnes_internes):
+        col_indexes.setdefault(col_name, i)
+    surlignage = {}
+
+    def colonnes_surlignees(code):
+        if code not in surlignage:
+            surlignage[code] = sorted({
+                col_indexes[col_name]
+                for anomaly_key, columns_to_highlight in anomaly_columns_map.items()
+                if code & ANOMALIE_BITS[anomaly_key]
+                for col_name in columns_to_highlight
+                if col_name in col_indexes
+            })
+        return surlignage[code]
+
+    wb = Workbook(write_only=True)
+    sheet_names = noms_feuilles(anomaly_index)
+
+    # Récapitulatif
+    ws_summary = wb.create_sheet(title="Récapitulatif")
+    summary_rows = [("Type d'anomalie", "Nombre de cas")] + recapitulatif_anomalies(anomalies_df, anomaly_index)
+    ws_summary.column_dimensions['A'].width = max(len("Récapitulatif des anomalies"), *(len(str(label)) for label, _ in summary_rows)) + 2
+    ws_summary.column_dimensions['B'].width = max(len(str(count)) for _, count in summary_rows) + 2
+
+    ws_summary.append([cellule(ws_summary, "Récapitulatif des anomalies", font=title_font)])
+    ws_summary.append([])
+    ws_summary.append([cellule(ws_summary, "Type d'anomalie", font=header_font), cellule(ws_summary, "Nombre de cas", font=header_font)])
+    ws_summary.append([
+        cellule(ws_summary, "Toutes les anomalies", font=link_font, hyperlink="#Toutes_Anomalies!A1"),
+        cellule(ws_summary, len(anomalies_df), alignment=Alignment(horizontal="right"))
+    ])
+    for (anomaly_type, positions), sheet_name in zip(anomaly_index.items(), sheet_names):
+        ws_summary.append([cellule(ws_summary, anomaly_type, font=link_font, hyperlink=f"#{sheet_name}!A1"), len(positions)])
+
+    # Toutes les anomalies
+    with mesurer(mesures, 'excel:Toutes_Anomalies', len(anomalies_df)):
+        ecrire_feuille_anomalies(wb, "Toutes_Anomalies", anomalies_df, None, codes, colonnes_surlignees)
+
+    # Une feuille par type d'anomalie
+    for positions, sheet_name in zip(anomaly_index.values(), sheet_names):
+        with mesurer(mesures, f'excel:{sheet_name}', len(positions)):
+            ecrire_feuille_anomalies(wb, sheet_name, anomalies_df, positions, codes[positions], colonnes_surlignees)
+
+    with mesurer(mesures, 'excel:enregistrement'):
+        wb.save(fichier)
+
+def ecrire_rapport_zip(anomalies_df, anomaly_index, fichier, delimiter=',', mesures=None):
+    """
+    Génère dans fichier (chemin ou objet fichier) une archive ZIP des
+    anomalies : 'recapitulatif.csv', 'anomalies.csv' et un CSV par type
+    d'anomalie dans 'par_type/', nommé comme la feuille correspondante du
+    rapport Excel. Chaque CSV est compressé au fil de son écriture.
+    """
+    with zipfile.ZipFile(fichier, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open('recapitulatif.csv', 'w') as sortie:
+            recapitulatif = pd.DataFrame(recapitulatif_anomalies(anomalies_df, anomaly_index),
+                                         columns=["Type d'anomalie", "Nombre de cas"])
+            recapitulatif.to_csv(sortie, index=False, sep=delimiter, encoding='utf-8')
+        with mesurer(mesures, 'zip:anomalies', len(anomalies_df)), archive.open('anomalies.csv', 'w', force_zip64=True) as sortie:
+            ecrire_csv(anomalies_df, sortie, delimiter)
+        for (anomaly_type, positions), nom in zip(anomaly_index.items(), noms_feuilles(anomaly_index)):
+            with mesurer(mesures, f'zip:{nom}', len(positions)), archive.open(f'par_type/{nom}.csv', 'w', force_zip64=True) as sortie:
+                ecrire_csv(anomalies_df, sortie, delimiter, positions)
@@ -0,0 +1,826 @@
+"""
+Règles de contrôle des données de radiorelève.
+"""
+import os
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+from .geographie import cles_communes, hors_commune, referentiel_communes
+from .mesures import mesurer
+
+# Version du jeu de règles, à incrémenter à chaque modification des contrôles ou de la
+# lecture des colonnes contrôlées, pour invalider les résultats mis en cache et l'historique
+VERSION_REGLES = '4'
+
+# Table de correspondance Diametre -> Lettre pour FP2E
+diametre_lettre = {
+    15: ['A', 'U', 'V'],
+    20: ['B'],
+    25: ['C'],
+    30: ['D'],
+    40: ['E'],
+    50: ['F'],
+    60: ['G'],
+    65: ['G'],
+    80: ['H'],
+    100: ['I'],
+    125: ['J'],
+    150: ['K']
+}
+
+# Table inverse Lettre -> Diamètres, construite à partir de diametre_lettre
+lettre_diametres = pd.MultiIndex.from_tuples(
+    [(lettre, float(diametre)) for diametre, lettres in diametre_lettre.items() for lettre in lettres],
+    names=['Lettre', 'Diametre']
+)
+
+# Chaînes adossées à Arrow pour les colonnes texte contrôlées
+TEXTE_ARROW = pd.StringDtype('pyarrow')
+
+FP2E_ANOMALIE_ANNEE = 'L\'année de millésime n\'est pas conforme'
+FP2E_ANOMALIE_DIAMETRE = 'Le diamètre n\'est pas conforme'
+
+# Format FP2E du numéro de compteur, avec extraction de l'année et de la lettre du diamètre
+fp2e_regex = r'^[A-Z]\d{2}[A-Z]{2}\d{6}$'
+fp2e_regex_extraction = r'^[A-Z](\d{2})[A-Z]([A-Z])\d{6}$'
+
+def extraire_fp2e(compteur):
+    """
+    Extrait l'année (colonne 0) et la lettre du diamètre (colonne 1) des
+    numéros de compteur au format FP2E ; NaN pour les autres.
+    """
+    return compteur.astype(TEXTE_ARROW).str.strip().str.extract(fp2e_regex_extraction)
+
+def fp2e_annee_non_conforme(extraction, annee_fabrication):
+    """
+    Compteurs FP2E dont l'année ne correspond pas à l'année de fabrication.
+    """
+    annee_fabrication = annee_fabrication.astype(str).str.strip()
+    annee_ok = annee_fabrication.str.isdigit().fillna(False).astype(bool) & (annee_fabrication.str.zfill(2) == extraction[0])
+    return extraction[0].notna() & ~annee_ok
+
+def fp2e_diametre_non_conforme(extraction, diametre):
+    """
+    Compteurs FP2E dont la lettre ne correspond pas au diamètre, par
+    recherche du couple (lettre, diamètre) dans la table de correspondance.
+    """
+    diametre = pd.to_numeric(diametre, errors='coerce').astype(float)
+    diametre_ok = pd.MultiIndex.from_arrays([extraction[1].str.upper(), diametre]).isin(lettre_diametres)
+    return extraction[0].notna() & ~diametre_ok
+
+# Colonnes nécessaires aux contrôles
+required_columns = ['Protocole Radio', 'Marque', 'Numéro de tête', 'Numéro de compteur', 'Latitude', 'Longitude', 'Commune', 'Année de fabrication', 'Diametre', 'Mode de relève']
+
+# Colonnes texte lues comme chaînes, pour que le typage ne dépende pas du contenu
+# du fichier (ni, en mode flux, d'un bloc à l'autre)
+colonnes_texte = ['Protocole Radio', 'Marque', 'Numéro de tête', 'Numéro de compteur', 'Commune', 'Mode de relève']
+
+class ColonnesManquantes(ValueError):
+    """
+    Levée lorsque le fichier ne contient pas toutes les colonnes requises.
+    """
+    def __init__(self, missing_columns):
+        self.missing_columns = missing_columns
+        super().__init__(f"Colonnes requises manquantes : {', '.join(missing_columns)}")
+
+def verifier_colonnes(df):
+    """
+    Vérifie que le DataFrame contient toutes les colonnes requises.
+    """
+    missing_columns = [col for col in required_columns if col not in df.columns]
+    if missing_columns:
+        raise ColonnesManquantes(missing_columns)
+
+# Nombre de lignes à partir duquel un même point GPS est signalé
+SEUIL_GPS_PARTAGE = 10
+
+# Colonnes comparées d'une ligne à l'autre par les règles transverses
+colonnes_transverses = ['Numéro de compteur', 'Numéro de tête', 'Latitude', 'Longitude', 'Commune']
+
+def cles_transverses(df, normaliser=False):
+    """
+    Clés comparées d'une ligne à l'autre par les règles transverses :
+    empreintes 64 bits du numéro de compteur ('compteur'), du numéro de tête
+    ('tete'), du point GPS ('gps') et de la commune ('commune') de chaque
+    ligne, et coordonnées ('Latitude', 'Longitude'). La clé est manquante si
+    la valeur est vide, et les coordonnées invalides sont remplacées par NaN.
+    df doit être normalisé (voir normaliser_donnees), sauf si normaliser est
+    vrai : seules les colonnes_transverses sont alors normalisées.
+    """
+    compteur, tete, latitude, longitude = (df[col] for col in colonnes_transverses[:4])
+    if normaliser:
+        compteur, tete = colonne_texte(compteur), colonne_texte(tete)
+        latitude, longitude = colonne_numerique(latitude), colonne_numerique(longitude)
+    gps_valide = (latitude.between(-90, 90) & longitude.between(-180, 180) & (latitude != 0) & (longitude != 0))
+    communes, communes_renseignees = cles_communes(df['Commune'])
+
+    def cle(valeurs, valide):
+        empreintes = pd.util.hash_pandas_object(valeurs, index=False, categorize=False).to_numpy().view(np.int64)
+        return pd.arrays.IntegerArray(empreintes, ~np.asarray(valide, dtype=bool))
+
+    return pd.DataFrame({
+        'compteur': cle(compteur.astype(object), compteur != ''),
+        'tete': cle(tete.astype(object), tete != ''),
+        'gps': cle(pd.DataFrame({'Latitude': latitude, 'Longitude': longitude}), gps_valide),
+        'commune': pd.arrays.IntegerArray(communes, ~communes_renseignees),
+        'Latitude': latitude.where(gps_valide),
+        'Longitude': longitude.where(gps_valide),
+    }, index=df.index)
+
+def effectifs_cles(cles):
+    """
+    Nombre de lignes partageant chacune des clés de chaque ligne (0 pour une
+    clé manquante), par regroupement des clés identiques.
+    """
+    effectifs = {}
+    for nom, cle in cles.items():
+        codes, uniques = pd.factorize(cle)
+        # Les clés manquantes (code -1) reçoivent le dernier effectif, nul
+        comptes = np.append(np.bincount(codes[codes >= 0], minlength=len(uniques)), 0)
+        effectifs[nom] = comptes[codes]
+    return pd.DataFrame(effectifs, index=cles.index)
+
+def valeurs_transverses(cles, referentiel=None):
+    """
+    Valeurs lues par les règles transverses pour chaque ligne, calculées sur
+    l'ensemble des lignes de cles (voir cles_transverses) : effectifs des
+    clés 'compteur', 'tete' et 'gps' (voir effectifs_cles) et
+    'gps_hors_commune' (voir hors_commune, avec le référentiel des communes
+    configuré si referentiel est None).
+    """
+    valeurs = effectifs_cles(cles[['compteur', 'tete', 'gps']])
+    valeurs['gps_hors_commune'] = hors_commune(
+        cles['commune'], cles['Latitude'].to_numpy(), cles['Longitude'].to_numpy(),
+        referentiel_communes() if referentiel is None else referentiel
+    )
+    return valeurs
+
+class Intermediaires:
+    """
+    Valeurs intermédiaires partagées par les règles (marqueurs de marque,
+    mode de relève, année numérique, contrôles FP2E...). Chacune est calculée
+    à la première utilisation, puis réutilisée par toutes les règles.
+    Les marqueurs des colonnes catégorielles (voir colonnes_categorielles)
+    sont évalués sur les catégories, puis diffusés aux lignes.
+    transverses, si fourni (voir valeurs_transverses), remplace les valeurs
+    des règles transverses calculées sur df.
+    """
+    def __init__(self, df, transverses=None):
+        self.df = df
+        self._categories = {}
+        if transverses is not None:
+            self.transverses = transverses
+
+    def drapeau(self, colonne, condition):
+        """
+        Évalue condition sur les catégories en majuscules de la colonne et
+        renvoie le masque booléen correspondant pour chaque ligne.
+        """
+        serie = self.df[colonne]
+        if colonne not in self._categories:
+            self._categories[colonne] = serie.cat.categories.str.upper()
+        par_categorie = np.asarray(condition(self._categories[colonne]), dtype=bool)
+        return pd.Series(par_categorie[serie.cat.codes.to_numpy()], index=serie.index)
+
+    @cached_property
+    def marques_presentes(self):
+        return set(self.df['Marque'].cat.categories.str.upper())
+
+    @cached_property
+    def marque_vide(self):
+        return self.drapeau('Marque', lambda marque: marque == '')
+
+    @cached_property
+    def is_kamstrup(self):
+        return self.drapeau('Marque', lambda marque: marque == 'KAMSTRUP')
+
+    @cached_property
+    def is_sappel(self):
+        return self.drapeau('Marque', lambda marque: marque.isin(['SAPPEL (C)', 'SAPPEL (H)']))
+
+    @cached_property
+    def is_sappel_c(self):
+        return self.drapeau('Marque', lambda marque: marque == 'SAPPEL (C)')
+
+    @cached_property
+    def is_sappel_h(self):
+        return self.drapeau('Marque', lambda marque: marque == 'SAPPEL (H)')
+
+    @cached_property
+    def is_itron(self):
+        return self.drapeau('Marque', lambda marque: marque == 'ITRON')
+
+    @cached_property
+    def manuelle(self):
+        return self.drapeau('Mode de relève', lambda mode: mode == 'MANUELLE')
+
+    @cached_property
+    def protocole_vide(self):
+        return self.drapeau('Protocole Radio', lambda protocole: protocole == '')
+
+    @cached_property
+    def protocole_wms(self):
+        return self.drapeau('Protocole Radio', lambda protocole: protocole == 'WMS')
+
+    @cached_property
+    def protocole_oms(self):
+        return self.drapeau('Protocole Radio', lambda protocole: protocole == 'OMS')
+
+    @cached_property
+    def compteur(self):
+        return self.df['Numéro de compteur']
+
+    @cached_property
+    def tete(self):
+        return self.df['Numéro de tête']
+
+    @cached_property
+    def compteur_vide(self):
+        return self.compteur.isin(['', 'nan'])
+
+    @cached_property
+    def compteur_c(self):
+        return self.compteur.str.startswith('C')
+
+    @cached_property
+    def compteur_h(self):
+        return self.compteur.str.startswith('H')
+
+    @cached_property
+    def tete_vide(self):
+        return self.tete.isin(['', 'nan'])
+
+    @cached_property
+    def tete_dme(self):
+        return self.tete.str.upper().str.startswith('DME')
+
+    @cached_property
+    def annee_num(self):
+        return colonne_numerique(self.df['Année de fabrication'])
+
+    @cached_property
+    def transverses(self):
+        return valeurs_transverses(cles_transverses(self.df))
+
+    @cached_property
+    def fp2e_applicable(self):
+        # Condition 1: La marque est SAPPEL ET le mode de relève n'est pas "MANUELLE"
+        sappel_non_manuelle = self.is_sappel & ~self.manuelle
+        # Condition 2: Le mode de relève est "MANUELLE" ET le numéro de compteur respecte le format FP2E
+        manuelle_format_ok = self.manuelle & self.compteur.str.match(fp2e_regex, na=False)
+        # Les contrôles FP2E ne s'appliquent que si l'une des deux conditions est vraie
+        return sappel_non_manuelle | manuelle_format_ok
+
+    @cached_property
+    def fp2e_extraction(self):
+        return extraire_fp2e(self.compteur[self.fp2e_applicable])
+
+    @cached_property
+    def fp2e_annee_non_conforme(self):
+        lignes = self.fp2e_extraction.index
+        return fp2e_annee_non_conforme(self.fp2e_extraction, self.df.loc[lignes, 'Année de fabrication']).reindex(self.df.index, fill_value=False)
+
+    @cached_property
+    def fp2e_diametre_non_conforme(self):
+        lignes = self.fp2e_extraction.index
+        return fp2e_diametre_non_conforme(self.fp2e_extraction, self.df.loc[lignes, 'Diametre']).reindex(self.df.index, fill_value=False)
+
+@dataclass(frozen=True)
+class Regle:
+    """
+    Règle de contrôle : identifiant, libellé de l'anomalie, colonnes lues
+    par la règle, colonnes à surligner dans le rapport et prédicat vectorisé
+    (fonction des Intermediaires renvoyant un masque booléen des lignes en
+    anomalie). Une règle propre à une marque est ignorée lorsqu'aucune ligne
+    du fichier ne porte l'une de ses marques. Une règle transverse compare
+    chaque ligne aux autres lignes du fichier (doublons) : son résultat pour
+    une ligne dépend de tout le fichier.
+    """
+    id: str
+    libelle: str
+    colonnes: tuple
+    surlignage: tuple
+    predicat: Callable
+    marques: tuple = ()
+    transverse: bool = False
+
+# Registre des règles : chaque type d'anomalie reçoit un bit dans la colonne
+# 'Code anomalie'. L'ordre du registre est celui d'affichage des libellés.
+REGLES = [
+    # ------------------------------------------------------------------
+    # ANOMALIES GÉNÉRALES
+    # ------------------------------------------------------------------
+    Regle('protocole_manquant', "Protocole Radio manquant",
+          ('Protocole Radio', 'Mode de relève'), ('Protocole Radio',),
+          lambda i: i.protocole_vide & ~i.manuelle),
+    Regle('marque_manquante', "Marque manquante",
+          ('Marque',), ('Marque',),
+          lambda i: i.marque_vide),
+    Regle('compteur_manquant', "Numéro de compteur manquant",
+          ('Numéro de compteur',), ('Numéro de compteur',),
+          lambda i: i.compteur_vide),
+    Regle('diametre_manquant', "Diamètre manquant",
+          ('Diametre',), ('Diametre',),
+          lambda i: i.df['Diametre'].isnull()),
+    Regle('annee_manquante', "Année de fabrication manquante",
+          ('Année de fabrication',), ('Année de fabrication',),
+          lambda i: i.df['Année de fabrication'].isnull()),
+    Regle('tete_manquante', "Numéro de tête manquant",
+          ('Numéro de tête', 'Marque', 'Année de fabrication', 'Mode de relève'), ('Numéro de tête',),
+          lambda i: i.tete_vide & (~i.is_sappel | (i.annee_num >= 22)) & ~i.manuelle),
+    Regle('gps_non_numerique', "Coordonnées GPS non numériques",
+          ('Latitude', 'Longitude'), ('Latitude', 'Longitude'),
+          lambda i: i.df['Latitude'].isnull() | i.df['Longitude'].isnull()),
+    Regle('gps_invalide', "Coordonnées GPS invalides",
+          ('Latitude', 'Longitude'), ('Latitude', 'Longitude'),
+          lambda i: ((i.df['Latitude'] == 0) | (~i.df['Latitude'].between(-90, 90))) |
+                    ((i.df['Longitude'] == 0) | (~i.df['Longitude'].between(-180, 180)))),
+
+    # ------------------------------------------------------------------
+    # ANOMALIES SPÉCIFIQUES AUX MARQUES
+    # ------------------------------------------------------------------
+    Regle('kamstrup_longueur', "KAMSTRUP: Compteur ≠ 8 caractères",
+          ('Marque', 'Numéro de compteur'), ('Numéro de compteur',),
+          lambda i: i.is_kamstrup & (i.compteur.str.len() != 8),
+          marques=('KAMSTRUP',)),
+    Regle('kamstrup_compteur_tete', "KAMSTRUP: Compteur ≠ Tête",
+          ('Marque', 'Numéro de compteur', 'Numéro de tête'), ('Numéro de compteur', 'Numéro de tête'),
+          lambda i: i.is_kamstrup & ~i.tete_vide & (i.compteur != i.tete),
+          marques=('KAMSTRUP',)),
+    Regle('kamstrup_non_numerique', "KAMSTRUP: Compteur ou Tête non numérique",
+          ('Marque', 'Numéro de compteur', 'Numéro de tête'), ('Numéro de compteur', 'Numéro de tête'),
+          lambda i: i.is_kamstrup & ~i.tete_vide & (~i.compteur.str.isdigit() | ~i.tete.str.isdigit()),
+          marques=('KAMSTRUP',)),
+    Regle('kamstrup_diametre', "KAMSTRUP: Diamètre hors plage",
+          ('Marque', 'Diametre'), ('Diametre',),
+          lambda i: i.is_kamstrup & (~i.df['Diametre'].between(15, 80)),
+          marques=('KAMSTRUP',)),
+    Regle('kamstrup_protocole', "KAMSTRUP: Protocole ≠ WMS",
+          ('Marque', 'Protocole Radio'), ('Protocole Radio',),
+          lambda i: i.is_kamstrup & ~i.protocole_wms,
+          marques=('KAMSTRUP',)),
+    Regle('sappel_tete_dme', "SAPPEL: Tête DME ≠ 15 caractères",
+          ('Marque', 'Numéro de tête'), ('Numéro de tête',),
+          lambda i: i.is_sappel & i.tete_dme & (i.tete.str.len() != 15),
+          marques=('SAPPEL (C)', 'SAPPEL (H)')),
+    # On applique la règle SAPPEL seulement si le mode n'est pas "Manuelle"
+    Regle('sappel_prefixe', "SAPPEL: Compteur ne commence pas par C ou H",
+          ('Marque', 'Mode de relève', 'Numéro de compteur'), ('Numéro de compteur',),
+          lambda i: i.is_sappel & ~i.manuelle & ~(i.compteur_c | i.compteur_h),
+          marques=('SAPPEL (C)', 'SAPPEL (H)')),
+    Regle('sappel_marque_c', "SAPPEL: Incohérence Marque/Compteur (C)",
+          ('Marque', 'Numéro de compteur'), ('Numéro de compteur',),
+          lambda i: i.is_sappel & i.compteur_c & ~i.is_sappel_c,
+          marques=('SAPPEL (C)', 'SAPPEL (H)')),
+    Regle('sappel_marque_h', "SAPPEL: Incohérence Marque/Compteur (H)",
+          ('Marque', 'Numéro de compteur'), ('Marque', 'Numéro de compteur'),
+          lambda i: i.is_sappel & i.compteur_h & ~i.is_sappel_h,
+          marques=('SAPPEL (C)', 'SAPPEL (H)')),
+    Regle('sappel_annee_tete', "SAPPEL: Année >22 & Tête ≠ DME",
+          ('Marque', 'Année de fabrication', 'Numéro de tête'), ('Année de fabrication', 'Numéro de tête'),
+          lambda i: i.is_sappel & (i.annee_num > 22) & ~i.tete_dme,
+          marques=('SAPPEL (C)', 'SAPPEL (H)')),
+    Regle('sappel_annee_protocole', "SAPPEL: Année >22 & Protocole ≠ OMS",
+          ('Marque', 'Année de fabrication', 'Protocole Radio'), ('Année de fabrication', 'Protocole Radio'),
+          lambda i: i.is_sappel & (i.annee_num > 22) & ~i.protocole_oms,
+          marques=('SAPPEL (C)', 'SAPPEL (H)')),
+    # On applique la règle ITRON seulement si le mode n'est pas "Manuelle"
+    Regle('itron_prefixe', "ITRON: Compteur ne commence pas par I ou D",
+          ('Marque', 'Mode de relève', 'Numéro de compteur'), ('Numéro de compteur',),
+          lambda i: i.is_itron & ~i.manuelle & (~i.compteur.str.startswith(('I', 'D'))),
+          marques=('ITRON',)),
+
+    # ------------------------------------------------------------------
+    # NORME FP2E
+    # ------------------------------------------------------------------
+    Regle('fp2e_annee', FP2E_ANOMALIE_ANNEE,
+          ('Marque', 'Mode de relève', 'Numéro de compteur', 'Année de fabrication'), ('Année de fabrication',),
+          lambda i: i.fp2e_annee_non_conforme),
+    Regle('fp2e_diametre', FP2E_ANOMALIE_DIAMETRE,
+          ('Marque', 'Mode de relève', 'Numéro de compteur', 'Diametre'), ('Diametre',),
+          lambda i: i.fp2e_diametre_non_conforme),
+
+    # ------------------------------------------------------------------
+    # ANOMALIES ENTRE LIGNES (DOUBLONS, COHÉRENCE AVEC LA COMMUNE)
+    # ------------------------------------------------------------------
+    Regle('compteur_doublon', "Numéro de compteur en doublon",
+          ('Numéro de compteur',), ('Numéro de compteur',),
+          lambda i: i.transverses['compteur'] > 1,
+          transverse=True),
+    Regle('tete_doublon', "Numéro de tête en doublon",
+          ('Numéro de tête',), ('Numéro de tête',),
+          lambda i: i.transverses['tete'] > 1,
+          transverse=True),
+    Regle('gps_partage', "Coordonnées GPS partagées par plusieurs compteurs",
+          ('Latitude', 'Longitude'), ('Latitude', 'Longitude'),
+          lambda i: i.transverses['gps'] >= SEUIL_GPS_PARTAGE,
+          transverse=True),
+    # Distance au centre de la commune (référentiel ou médianes du fichier), voir geographie
+    Regle('gps_hors_commune', "Coordonnées GPS éloignées de la commune",
+          ('Latitude', 'Longitude', 'Commune'), ('Latitude', 'Longitude'),
+          lambda i: i.transverses['gps_hors_commune'],
+          transverse=True),
+]
+
+REGLES_TRANSVERSES = [regle for regle in REGLES if regle.transverse]
+
+ANOMALIES = [regle.libelle for regle in REGLES]
+ANOMALIE_BITS = {libelle: 1 << i for i, libelle in enumerate(ANOMALIES)}
+FP2E_BITS = ANOMALIE_BITS[FP2E_ANOMALIE_ANNEE] | ANOMALIE_BITS[FP2E_ANOMALIE_DIAMETRE]
+
+# Colonnes à surligner dans le rapport Excel pour chaque type d'anomalie
+anomaly_columns_map = {regle.libelle: list(regle.surlignage) for regle in REGLES}
+
+def libelles_anomalies(codes, masque=-1):
+    """
+    Convertit une Series de codes d'anomalie en libellés lisibles
+    ('Anomalie 1 / Anomalie 2'). Seuls les bits présents dans masque sont
+    décodés, et chaque combinaison distincte n'est décodée qu'une seule fois.
+    """
+    codes = codes & masque
+    correspondance = {
+        code: ' / '.join(libelle for libelle, bit in ANOMALIE_BITS.items() if code & bit)
+        for code in pd.unique(codes)
+    }
+    return codes.map(correspondance)
+
+def indexer_anomalies(codes):
+    """
+    Construit l'index inversé type d'anomalie -> positions des lignes
+    concernées (dans l'ordre de codes), du type le plus fréquent au moins
+    fréquent. Les lignes sont regroupées une seule fois par code distinct,
+    puis chaque type d'anomalie réunit les groupes dont le code contient son bit.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    codes_uniques, groupes = np.unique(codes, return_inverse=True)
+    ordre = np.argsort(groupes, kind='stable')
+    bornes = np.concatenate([[0], np.cumsum(np.bincount(groupes, minlength=len(codes_uniques)))])
+
+    anomaly_index = {}
+    for anomalie, bit in ANOMALIE_BITS.items():
+        groupes_concernes = np.flatnonzero(codes_uniques & bit)
+        if len(groupes_concernes):
+            anomaly_index[anomalie] = np.sort(np.concatenate([ordre[bornes[g]:bornes[g + 1]] for g in groupes_concernes]))
+    return dict(sorted(anomaly_index.items(), key=lambda item: -len(item[1])))
+
+def compter_anomalies(anomaly_index):
+    """
+    Nombre de lignes concernées par chaque type d'anomalie, à partir de
+    l'index inversé des anomalies.
+    """
+    return pd.Series(
+        [len(positions) for positions in anomaly_index.values()],
+        index=pd.Index(list(anomaly_index), name='Anomalie'),
+        name='count',
+        dtype='int64'
+    )
+
+def regles_dependantes(colonnes):
+    """
+    Règles qui lisent au moins une des colonnes données.
+    """
+    colonnes = set(colonnes)
+    return [regle for regle in REGLES if colonnes.intersection(regle.colonnes)]
+
+def detecter_colonnes_modifiees(ancien_df, nouveau_df):
+    """
+    Colonnes requises dont le contenu diffère entre deux versions d'un même
+    fichier. Renvoie None si les deux fichiers ne sont pas comparables
+    (lignes différentes ou colonne requise absente).
+    """
+    if not ancien_df.index.equals(nouveau_df.index):
+        return None
+    if any(col not in ancien_df.columns or col not in nouveau_df.columns for col in required_columns):
+        return None
+    return [col for col in required_columns if not ancien_df[col].equals(nouveau_df[col])]
+
+def evaluer_regles(df, regles=REGLES, codes=None, mesures=None, transverses=None):
+    """
+    Évalue les règles sur le DataFrame normalisé et renvoie le masque de bits
+    des anomalies de chaque ligne. Si codes est fourni, seuls les bits des
+    règles évaluées sont recalculés, les autres sont conservés.
+    transverses, si fourni, est transmis aux Intermediaires (règles
+    transverses évaluées par rapport à un fichier plus large que df).
+    Le temps mesuré pour une règle comprend le calcul des intermédiaires
+    qu'elle est la première à utiliser.
+    """
+    codes = np.zeros(len(df), dtype=np.int64) if codes is None else codes.copy()
+    intermediaires = Intermediaires(df, transverses)
+    for regle in regles:
+        bit = ANOMALIE_BITS[regle.libelle]
+        codes &= ~bit
+        # Les règles d'une marque absente du fichier ne sont pas évaluées
+        if regle.marques and not intermediaires.marques_presentes.intersection(regle.marques):
+            continue
+        with mesurer(mesures, f'regle:{regle.id}', len(df)) as mesure:
+            masque = np.asarray(regle.predicat(intermediaires), dtype=bool)
+            codes[masque] |= bit
+            mesure['lignes_en_anomalie'] = int(masque.sum())
+    return codes
+
+def colonne_texte(serie):
+    """
+    Convertit une colonne en chaînes adossées à Arrow ; les valeurs
+    manquantes et les chaînes 'nan' sont remplacées par des chaînes vides.
+    """
+    return serie.astype(TEXTE_ARROW).fillna('').replace('nan', '')
+
+def colonne_numerique(serie):
+    """
+    Convertit une colonne en nombres, les valeurs non numériques devenant
+    NaN. Les types nullables obtenus depuis des chaînes Arrow sont ramenés
+    aux types NumPy (NaN plutôt que NA) attendus par les règles.
+    """
+    nombres = pd.to_numeric(serie, errors='coerce')
+    if isinstance(nombres.dtype, pd.api.extensions.ExtensionDtype):
+        nombres = nombres.astype(float if nombres.hasnans else nombres.dtype.numpy_dtype)
+    return nombres
+
+# Colonnes à peu de valeurs distinctes, converties en catégories à la normalisation
+colonnes_categorielles = ['Marque', 'Protocole Radio', 'Mode de relève']
+
+def colonne_categorielle(serie):
+    """
+    Convertit une colonne à peu de valeurs distinctes en catégorie. Le texte
+    des valeurs est calculé une fois par valeur distincte ; les valeurs
+    manquantes et les chaînes 'nan' deviennent la catégorie ''.
+    """
+    codes, valeurs = pd.factorize(serie)
+    # La dernière position reçoit les valeurs manquantes (code -1)
+    textes = np.array([str(valeur) for valeur in valeurs] + [''], dtype=object)
+    textes[textes == 'nan'] = ''
+    codes_textes, categories = pd.factorize(textes)
+    return pd.Series(pd.Categorical.from_codes(codes_textes[codes], categories=categories), index=serie.index, name=serie.name)
+
+def colonne_annee(serie):
+    """
+    Année de fabrication sur deux chiffres, en chaînes Arrow : les valeurs
+    numériques ('2015', '2015.0') sont ramenées à leur partie entière, puis
+    chaque valeur à ses deux derniers caractères, complétés par des zéros.
+    Le calcul est fait une fois par valeur distincte, en une seule
+    expression régulière.
+    """
+    codes, valeurs = pd.factorize(serie)
+    # La dernière position reçoit les valeurs manquantes (code -1)
+    textes = colonne_texte(pd.concat([pd.Series(valeurs), pd.Series([''], dtype=object)], ignore_index=True))
+    annees = textes.str.replace(r'^([0-9]+)\.[0-9]*$|^\.[0-9]+$', r'\1', regex=True).str.slice(-2).str.zfill(2)
+    return pd.Series(annees.array.take(codes), index=serie.index, name=serie.name)
+
+# Conversion de chaque colonne requise à la normalisation
+conversions = {
+    'Année de fabrication': colonne_annee,
+    'Numéro de compteur': colonne_texte,
+    'Numéro de tête': colonne_texte,
+    **dict.fromkeys(colonnes_categorielles, colonne_categorielle),
+    'Latitude': colonne_numerique,
+    'Longitude': colonne_numerique,
+    'Diametre': colonne_numerique,
+}
+
+def normaliser_donnees(df, lignes=None):
+    """
+    Prépare le tableau de travail des contrôles : les seules colonnes
+    requises, converties une fois chacune (année de fabrication sur deux
+    chiffres, marque, protocole et mode de relève en catégories, numéros en
+    chaînes Arrow sans valeurs manquantes, colonnes numériques converties),
+    pour toutes les lignes de df ou pour les positions lignes.
+    Les autres colonnes de df ne sont ni copiées ni converties ; elles ne
+    sont reprises que pour les lignes en anomalie (voir joindre_colonnes).
+    """
+    colonnes = {col: df[col] if lignes is None else df[col].take(lignes) for col in required_columns}
+    return pd.DataFrame({
+        col: conversions[col](serie) if col in conversions else serie for col, serie in colonnes.items()
+    }, index=df.index if lignes is None else df.index[lignes], copy=False)
+
+def joindre_colonnes(lignes, travail):
+    """
+    Remplace sur place les colonnes requises de lignes (lignes extraites du
+    DataFrame d'origine, avec toutes ses colonnes) par leurs valeurs
+    normalisées de travail, pour les mêmes lignes. Renvoie lignes.
+    """
+    for col in travail.columns:
+        lignes[col] = travail[col].array
+    return lignes
+
+# Budget de mémoire de travail des contrôles d'un DataFrame ; au-delà, les lignes sont contrôlées par blocs
+BUDGET_MEMOIRE = int(os.environ.get('CONTROLE_BUDGET_MEMOIRE_MO', '1024')) * 1024 * 1024
+
+# Mémoire de travail des contrôles par ligne (tableau de travail, intermédiaires et masques des règles),
+# relevée avec le banc de mesure
+OCTETS_PAR_LIGNE = 300
+
+# Mémoire des valeurs des règles transverses par ligne, gardées pour toutes les lignes pendant un contrôle
+# par blocs (relevée avec le banc de mesure)
+OCTETS_TRANSVERSES_PAR_LIGNE = 30
+
+# Taille minimale des blocs de lignes, quel que soit le budget
+LIGNES_MIN_BLOC = 10_000
+
+def lignes_par_bloc(nb_lignes, budget=BUDGET_MEMOIRE, processus=1):
+    """
+    Nombre de lignes à contrôler à la fois, par chacun des processus
+    simultanés, pour que la mémoire de travail des contrôles de nb_lignes
+    lignes reste dans budget (octets) : toutes si elle y tient ou si budget
+    est None. Sinon, la mémoire des valeurs des règles transverses de toutes
+    les lignes, gardées pendant tout le contrôle, est déduite du budget
+    avant de le répartir entre les blocs des processus. Les blocs comptent
+    au moins LIGNES_MIN_BLOC lignes, même si le budget ne le permet pas.
+    """
+    if budget is None or nb_lignes * OCTETS_PAR_LIGNE <= budget:
+        return max(nb_lignes, 1)
+    reste = budget - nb_lignes * OCTETS_TRANSVERSES_PAR_LIGNE
+    return max(reste // (processus * OCTETS_PAR_LIGNE), LIGNES_MIN_BLOC)
+
+def check_data(df, precedent=None, colonnes_modifiees=None, mesures=None, transverses=None, budget=BUDGET_MEMOIRE):
+    """
+    Vérifie les données du DataFrame pour détecter les anomalies en utilisant des opérations vectorisées.
+    Retourne les lignes en anomalie, le nombre de cas par type d'anomalie et
+    l'index inversé type d'anomalie -> positions des lignes. Au-delà de
+    budget, df est contrôlé par blocs (voir check_data_par_lignes).
+    Lève ColonnesManquantes si une colonne requise est absente.
+    """
+    # Vérification des colonnes requises
+    verifier_colonnes(df)
+
+    taille_bloc = lignes_par_bloc(len(df), budget)
+    if taille_bloc < len(df):
+        return check_data_par_lignes(df, taille_bloc, mesures, transverses)
+
+    with mesurer(mesures, 'normalisation', len(df)):
+        travail = normaliser_donnees(df)
+
+    # Reprise des anomalies du contrôle précédent pour les règles non concernées par les modifications
+    regles = REGLES
+    codes = None
+    if precedent is not None and colonnes_modifiees is not None:
+        positions = travail.index.get_indexer(precedent['Index original'])
+        if (positions >= 0).all():
+            codes = np.zeros(len(travail), dtype=np.int64)
+            codes[positions] = precedent['Code anomalie'].to_numpy()
+            regles = regles_dependantes(colonnes_modifiees)
+
+    # Masque de bits des anomalies de chaque ligne
+    codes = evaluer_regles(travail, regles, codes, mesures, transverses)
+
+    # Seules les lignes en anomalie sont reprises avec toutes leurs colonnes
+    positions = np.flatnonzero(codes)
+    with mesurer(mesures, 'jointure', len(positions)):
+        anomalies_df = joindre_colonnes(df.take(positions), travail.take(positions))
+    return resultats_controle(anomalies_df, codes[positions], mesures)
+
+def resultats_controle(anomalies_df, codes, mesures=None):
+    """
+    Construit les résultats d'un contrôle à partir des lignes en anomalie
+    (colonnes d'origine et colonnes normalisées, voir joindre_colonnes) et
+    de leur masque de bits : DataFrame des anomalies, nombre de cas par type
+    et index inversé (voir check_data). anomalies_df, propre à l'appelant,
+    est complété sur place.
+    """
+    # Construction des libellés uniquement pour les lignes en anomalie
+    with mesurer(mesures, 'libelles', len(anomalies_df)):
+        anomalies_df['Code anomalie'] = codes
+        anomalies_df['Anomalie'] = libelles_anomalies(anomalies_df['Code anomalie'])
+        anomalies_df['Anomalie Détaillée FP2E'] = libelles_anomalies(anomalies_df['Code anomalie'], FP2E_BITS)
+        anomalies_df.reset_index(inplace=True)
+        anomalies_df.rename(columns={'index': 'Index original'}, inplace=True)
+    
+    # Index inversé des anomalies et comptage pour le résumé, directement à partir des codes
+    with mesurer(mesures, 'index_anomalies', len(anomalies_df)):
+        anomaly_index = indexer_anomalies(anomalies_df['Code anomalie'])
+        anomaly_counter = compter_anomalies(anomaly_index)
+    
+    return anomalies_df, anomaly_counter, anomaly_index
+
+def controler_blocs(blocs, transverses, categories=None, progression=None, mesures=None):
+    """
+    Contrôle avec check_data chacun des blocs de lignes successifs d'un même
+    fichier et assemble leurs résultats comme ceux du fichier complet.
+    transverses donne les valeurs des règles transverses de toutes les
+    lignes du fichier (voir valeurs_transverses), dans l'ordre des blocs.
+    Les colonnes catégorielles des anomalies reçoivent les categories
+    fournies (par colonne) ou, à défaut, celles de tous les blocs, dans
+    l'ordre d'apparition. progression, si fourni, est appelé après chaque
+    bloc avec le nombre de lignes contrôlées.
+    """
+    blocs_anomalies = []
+    index_blocs = {}
+    nb_lignes = 0
+    nb_anomalies = 0
+    for bloc in blocs:
+        anomalies_bloc, _, index_bloc = check_data(
+            bloc, mesures=mesures, transverses=transverses.iloc[nb_lignes:nb_lignes + len(bloc)], budget=None
+        )
+        blocs_anomalies.append(anomalies_bloc)
+        # Les positions du bloc sont décalées du nombre d'anomalies des blocs précédents
+        for anomalie, positions in index_bloc.items():
+            index_blocs.setdefault(anomalie, []).append(positions + nb_anomalies)
+        nb_anomalies += len(anomalies_bloc)
+        nb_lignes += len(bloc)
+        if progression is not None:
+            progression(nb_lignes)
+
+    # Des catégories communes évitent que la concaténation ne convertisse les colonnes en objets
+    for col in colonnes_categorielles:
+        categories_col = (pd.unique(np.concatenate([bloc[col].cat.categories.to_numpy() for bloc in blocs_anomalies]))
+                          if categories is None else categories[col])
+        for bloc in blocs_anomalies:
+            bloc[col] = bloc[col].cat.set_categories(categories_col)
+    anomalies_df = pd.concat(blocs_anomalies, ignore_index=True)
+
+    # Fusion des index et des comptages des différents blocs, dans l'ordre du registre des anomalies
+    anomaly_index = {anomalie: np.concatenate(index_blocs[anomalie]) for anomalie in ANOMALIES if anomalie in index_blocs}
+    anomaly_index = dict(sorted(anomaly_index.items(), key=lambda item: -len(item[1])))
+    anomaly_counter = compter_anomalies(anomaly_index)
+
+    return anomalies_df, anomaly_counter, anomaly_index
+
+def transverses_blocs(blocs):
+    """
+    Valeurs des règles transverses (voir valeurs_transverses) de toutes les
+    lignes des blocs successifs d'un même fichier. Seules les clés de chaque
+    bloc (voir cles_transverses) sont conservées jusqu'au regroupement.
+    """
+    return valeurs_transverses(pd.concat([cles_transverses(bloc, normaliser=True) for bloc in blocs]))
+
+def categories_blocs(blocs):
+    """
+    Catégories de chacune des colonnes_categorielles pour l'ensemble des
+    blocs successifs d'un même fichier, dans l'ordre que leur donnerait
+    colonne_categorielle sur les colonnes complètes. Seules les valeurs
+    distinctes de chaque bloc sont conservées.
+    """
+    distinctes = {col: [] for col in colonnes_categorielles}
+    for bloc in blocs:
+        for col, valeurs in distinctes.items():
+            valeurs.append(pd.Series(pd.unique(bloc[col])))
+    return {col: colonne_categorielle(pd.concat(valeurs, ignore_index=True)).cat.categories
+            for col, valeurs in distinctes.items()}
+
+def check_data_par_lignes(df, taille_bloc, mesures=None, transverses=None):
+    """
+    Équivalent de check_data pour un DataFrame dont la mémoire de travail
+    des contrôles dépasserait le budget : les lignes sont contrôlées par
+    blocs de taille_bloc lignes, après le calcul, bloc par bloc, des valeurs
+    des règles transverses (sauf si transverses est fourni) et des
+    catégories des colonnes catégorielles de l'ensemble de df. Les valeurs
+    transverses restent en mémoire pendant tout le contrôle (voir
+    lignes_par_bloc) ; leur calcul demande environ 120 octets par ligne de
+    df, qui peuvent à eux seuls dépasser le budget.
+    """
+    verifier_colonnes(df)
+
+    def blocs():
+        return (df.iloc[debut:debut + taille_bloc] for debut in range(0, len(df), taille_bloc))
+
+    if transverses is None:
+        with mesurer(mesures, 'cles_transverses', len(df)):
+            transverses = transverses_blocs(blocs())
+    # Catégories de l'ensemble des lignes, comme pour un contrôle en une fois
+    with mesurer(mesures, 'categories', len(df)):
+        categories = categories_blocs(blocs())
+    return controler_blocs(blocs(), transverses, categories, mesures=mesures)
+
+# Nombre de lignes lues à la fois en mode flux
+TAILLE_BLOC = 100_000
+
+def check_data_par_blocs(file, delimiter, dtype_mapping=None, taille_bloc=TAILLE_BLOC, progression=None, mesures=None,
+                         encoding='utf-8', usecols=None):
+    """
+    Mode flux pour les fichiers CSV volumineux : file est lu par blocs de
+    taille_bloc lignes, contrôlés avec check_data, dont seules les lignes en
+    anomalie sont conservées. file est relu une première fois pour les
+    règles transverses (voir transverses_blocs).
+    """
+    dtype_blocs = dict.fromkeys(colonnes_texte, str)
+    dtype_blocs.update(dtype_mapping or {})
+
+    # Vérification des colonnes requises sur l'en-tête, avant la première passe
+    verifier_colonnes(pd.read_csv(file, sep=delimiter, encoding=encoding, usecols=usecols, nrows=0))
+    if hasattr(file, 'seek'):
+        file.seek(0)
+
+    # Première passe : valeurs des règles transverses sur l'ensemble du fichier
+    with mesurer(mesures, 'cles_transverses') as mesure:
+        with pd.read_csv(file, sep=delimiter, dtype=dtype_blocs, chunksize=taille_bloc, encoding=encoding,
+                         usecols=colonnes_transverses) as lecteur:
+            transverses = transverses_blocs(lecteur)
+        mesure['lignes'] = len(transverses)
+    if hasattr(file, 'seek'):
+        file.seek(0)
+
+    def blocs_lus(lecteur):
+        blocs = iter(lecteur)
+        while True:
+            with mesurer(mesures, 'lecture_bloc') as mesure:
+                bloc = next(blocs, None)
+                mesure['lignes'] = 0 if bloc is None else len(bloc)
+            if bloc is None:
+                return
+            yield bloc
+
+    with pd.read_csv(file, sep=delimiter, dtype=dtype_blocs, chunksize=taille_bloc, encoding=encoding, usecols=usecols) as lecteur:
+        return controler_blocs(blocs_lus(lecteur), transverses, progression=progression, mesures=mesures)
@@ -0,0 +1,134 @@
+"""
+Exécution des contrôles en tâche de fond.
+
+Les tâches sont exécutées par un groupe de fils d'exécution partagé, si
+bien que plusieurs utilisateurs peuvent lancer des contrôles sans se
+bloquer mutuellement et que l'interface reste disponible pendant les
+contrôles. Une tâche est aussi l'objet Mesures transmis aux fonctions de
+contrôle et d'export : chaque étape mesurée fait avancer la progression de
+l'étape de la tâche en cours et permet d'interrompre la tâche lorsque son
+annulation a été demandée. Les résultats sont publiés dès qu'ils sont
+prêts, pour être proposés au téléchargement avant la fin de la tâche.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from .mesures import Mesures
+
+# Nombre de tâches exécutées simultanément, les suivantes sont mises en attente
+TACHES_SIMULTANEES = int(os.environ.get('CONTROLE_TACHES_SIMULTANEES', 4))
+
+EN_ATTENTE = 'en attente'
+EN_COURS = 'en cours'
+TERMINEE = 'terminée'
+ANNULEE = 'annulée'
+ECHEC = 'échec'
+
+class TacheAnnulee(Exception):
+    """
+    Levée dans une tâche dont l'annulation a été demandée, à l'étape
+    mesurée suivante.
+    """
+
+class Tache(Mesures):
+    """
+    Tâche de fond composée d'étapes nommées : état, progression de chaque
+    étape (entre 0 et 1), résultats publiés, erreur éventuelle et étape
+    au cours de laquelle elle s'est produite.
+    """
+    def __init__(self, etapes):
+        super().__init__()
+        self.etat = EN_ATTENTE
+        self.progression = dict.fromkeys(etapes, 0.0)
+        self.resultats = {}
+        self.erreur = None
+        self.etape_echec = None
+        self._annulation = threading.Event()
+        self._etape = None
+        self._sous_etapes = 0
+        self._sous_etapes_faites = 0
+
+    def annuler(self):
+        """
+        Demande l'annulation de la tâche, effective à l'étape mesurée suivante.
+        """
+        self._annulation.set()
+
+    def verifier_annulation(self):
+        """
+        Lève TacheAnnulee si l'annulation de la tâche a été demandée.
+        """
+        if self._annulation.is_set():
+            raise TacheAnnulee()
+
+    @property
+    def active(self):
+        return self.etat in (EN_ATTENTE, EN_COURS)
+
+    def commencer(self, etape, sous_etapes=0):
+        """
+        Passe à l'étape donnée, dont la progression avance à chacune des
+        sous_etapes étapes mesurées attendues.
+        """
+        self.verifier_annulation()
+        self._etape = etape
+        self._sous_etapes = sous_etapes
+        self._sous_etapes_faites = 0
+
+    def avancer(self, fraction):
+        """
+        Fixe la progression de l'étape en cours (par exemple d'après la
+        position de lecture d'un fichier).
+        """
+        self.verifier_annulation()
+        self.progression[self._etape] = min(max(fraction, 0.0), 1.0)
+
+    def terminer(self, etape, **resultats):
+        """
+        Termine l'étape donnée et publie ses résultats.
+        """
+        self.progression[etape] = 1.0
+        self.resultats.update(resultats)
+
+    @contextmanager
+    def etape(self, nom, nb_lignes=None):
+        self.verifier_annulation()
+        with super().etape(nom, nb_lignes) as mesure:
+            yield mesure
+        if self._etape is not None and self._sous_etapes:
+            self._sous_etapes_faites += 1
+            self.progression[self._etape] = min(self._sous_etapes_faites / self._sous_etapes, 0.99)
+
+class GestionnaireTaches:
+    """
+    Exécute les tâches dans un groupe de taches_simultanees fils d'exécution.
+    """
+    def __init__(self, taches_simultanees=TACHES_SIMULTANEES):
+        self._executeur = ThreadPoolExecutor(max_workers=taches_simultanees, thread_name_prefix='controle')
+
+    def lancer(self, etapes, fonction, *args, **kwargs):
+        """
+        Crée une tâche composée des etapes données et exécute
+        fonction(tache, *args, **kwargs) en tâche de fond. Renvoie la tâche.
+        """
+        tache = Tache(etapes)
+        self._executeur.submit(self._executer, tache, fonction, args, kwargs)
+        return tache
+
+    @staticmethod
+    def _executer(tache, fonction, args, kwargs):
+        if tache._annulation.is_set():
+            tache.etat = ANNULEE
+            return
+        tache.etat = EN_COURS
+        try:
+            fonction(tache, *args, **kwargs)
+            tache.etat = TERMINEE
+        except TacheAnnulee:
+            tache.etat = ANNULEE
+        except Exception as e:
+            tache.erreur = e
+            tache.etape_echec = tache._etape
+            tache.etat = ECHEC
@@ -0,0 +1,141 @@
+"""
+Non-régression des contrôles FP2E : les anomalies FP2E de check_data sont
+comparées, sur des valeurs limites, à celles de l'implémentation ligne par
+ligne d'origine (check_fp2e_details, appliquée après la normalisation
+d'origine des colonnes).
+"""
+import itertools
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from controle import check_data
+
+def check_fp2e_details(row):
+    """
+    Vérifie les détails de la norme FP2E et renvoie une chaîne détaillée
+    du problème (implémentation ligne par ligne d'origine).
+    """
+    anomalies = []
+
+    try:
+        compteur = str(row['Numéro de compteur']).strip()
+        annee_fabrication_val = str(row['Année de fabrication']).strip()
+        diametre_val = row['Diametre']
+
+        # Vérification 1 : Format du compteur
+        fp2e_regex = r'^[A-Z]\d{2}[A-Z]{2}\d{6}$'
+        if not re.match(fp2e_regex, compteur):
+            return 'Conforme'
+
+        annee_compteur = compteur[1:3]
+        lettre_diam = compteur[4].upper()
+
+        # Vérification 2 : Année de fabrication
+        if annee_fabrication_val == '' or not annee_fabrication_val.isdigit():
+            anomalies.append('L\'année de millésime n\'est pas conforme')
+        else:
+            annee_fabrication_padded = annee_fabrication_val.zfill(2)
+            if annee_compteur != annee_fabrication_padded:
+                anomalies.append('L\'année de millésime n\'est pas conforme')
+
+        # Vérification 3 : Diamètre
+        fp2e_map = {'A': 15, 'U': 15, 'V': 15, 'B': 20, 'C': 25, 'D': 30, 'E': 40, 'F': 50, 'G': [60, 65], 'H': 80, 'I': 100, 'J': 125, 'K': 150}
+        expected_diametres = fp2e_map.get(lettre_diam, [])
+        if not isinstance(expected_diametres, list):
+            expected_diametres = [expected_diametres]
+
+        if pd.isna(diametre_val) or diametre_val not in expected_diametres:
+            anomalies.append('Le diamètre n\'est pas conforme')
+
+    except (TypeError, ValueError, IndexError):
+        anomalies.append('Le numéro de compteur n\'est pas conforme')
+
+    if not anomalies:
+        return 'Conforme'
+    else:
+        return ' / '.join(anomalies)
+
+def details_fp2e_origine(df):
+    """
+    Détail FP2E attendu pour chaque ligne de df ('' si la ligne est
+    conforme ou n'est pas concernée), avec la normalisation et les
+    conditions d'application d'origine.
+    """
+    df = df.copy()
+    annee = df['Année de fabrication'].astype(str).replace('nan', '', regex=False)
+    annee = annee.apply(lambda x: str(int(float(x))) if x.replace('.', '', 1).isdigit() and x != '' else x)
+    df['Année de fabrication'] = annee.str.slice(-2).str.zfill(2)
+    for col in ['Numéro de compteur', 'Marque', 'Mode de relève']:
+        df[col] = df[col].astype(str).replace('nan', '', regex=False)
+    df['Diametre'] = pd.to_numeric(df['Diametre'], errors='coerce')
+
+    is_sappel = df['Marque'].str.upper().isin(['SAPPEL (C)', 'SAPPEL (H)'])
+    manuelle = df['Mode de relève'].str.upper() == 'MANUELLE'
+    manuelle_format_ok = manuelle & df['Numéro de compteur'].str.match(r'^[A-Z]\d{2}[A-Z]{2}\d{6}$', na=False)
+    details = pd.Series('', index=df.index, dtype=object)
+    for index, row in df[(is_sappel & ~manuelle) | manuelle_format_ok].iterrows():
+        detail = check_fp2e_details(row)
+        details[index] = '' if detail == 'Conforme' else detail
+    return details
+
+# Valeurs limites combinées entre elles
+COMPTEURS = ['C15AG123456', 'H15AU123456', 'H15ag123456', ' C15AG123456 ', 'C15AG12345', 'C15AG1234567', 'C1AG123456',
+             'C15AZ123456', 'C15UA123456', 'c15GA123456', '', np.nan, '12345678']
+ANNEES = ['15', '2015', '2015.0', '15.0', '5', '05', '2005', 'abc', '20a5', '', np.nan, '2016']
+DIAMETRES = [60, 65, 15, '65', '65.0', 'abc', '', np.nan, 0, 62]
+MARQUES_MODES = [('SAPPEL (C)', 'Radio'), ('SAPPEL (H)', 'MANUELLE'), ('ITRON', 'manuelle'), ('ITRON', 'Radio'),
+                 (np.nan, np.nan)]
+
+def donnees(lignes):
+    """
+    DataFrame complet (toutes les colonnes requises) à partir de tuples
+    (compteur, année, diamètre, marque, mode de relève).
+    """
+    compteurs, annees, diametres, marques, modes = zip(*lignes)
+    return pd.DataFrame({
+        'Protocole Radio': 'OMS',
+        'Marque': pd.Series(marques, dtype=object),
+        'Numéro de tête': 'DME123456789012',
+        'Numéro de compteur': pd.Series(compteurs, dtype=object),
+        'Latitude': 45.0,
+        'Longitude': 5.0,
+        'Commune': 'LYON',
+        'Année de fabrication': pd.Series(annees, dtype=object),
+        'Diametre': pd.Series(diametres, dtype=object),
+        'Mode de relève': pd.Series(modes, dtype=object),
+    })
+
+def details_fp2e(df):
+    """
+    Détail FP2E de chaque ligne de df selon check_data ('' si la ligne n'a
+    pas d'anomalie FP2E).
+    """
+    anomalies_df, _, _ = check_data(df, budget=None)
+    details = pd.Series('', index=df.index, dtype=object)
+    details[anomalies_df['Index original'].to_numpy()] = anomalies_df['Anomalie Détaillée FP2E'].to_numpy()
+    return details
+
+def test_details_fp2e_valeurs_limites():
+    lignes = [(compteur, annee, diametre, marque, mode)
+              for compteur, annee, diametre, (marque, mode)
+              in itertools.product(COMPTEURS, ANNEES, DIAMETRES, MARQUES_MODES)]
+    df = donnees(lignes)
+    pd.testing.assert_series_equal(details_fp2e(df), details_fp2e_origine(df))
+
+@pytest.mark.parametrize('ligne, detail', [
+    (('C15AG123456', '2015', 65, 'SAPPEL (C)', 'Radio'), ''),
+    (('C16AG123456', '2015', 65, 'SAPPEL (C)', 'Radio'), "L'année de millésime n'est pas conforme"),
+    (('C15AG123456', '15', 'abc', 'SAPPEL (C)', 'Radio'), "Le diamètre n'est pas conforme"),
+    (('C15AG123456', 'abc', np.nan, 'SAPPEL (C)', 'Radio'),
+     "L'année de millésime n'est pas conforme / Le diamètre n'est pas conforme"),
+    (('C15AG12345', 'abc', np.nan, 'SAPPEL (C)', 'Radio'), ''),
+    (('C15AG123456', 'abc', np.nan, 'ITRON', 'Radio'), ''),
+    (('C15AG123456', 'abc', 60, 'ITRON', 'MANUELLE'), "L'année de millésime n'est pas conforme"),
+])
+def test_details_fp2e(ligne, detail):
+    df = donnees([ligne])
+    assert details_fp2e(df)[0] == detail
+    assert details_fp2e_origine(df)[0] == detail